@@ -0,0 +1,11 @@
+"""
+Benchmarks for the build performance of Statigen. Synthetic sites for the
+`default/docs` and `default/blog` site templates are generated with
+#benchmarks.sitegen and built with #statigen.main() in a fresh interpreter
+for every measurement. See `python -m benchmarks --help`.
+
+    $ python -m benchmarks run --pages 500 -o before.json
+    $ git checkout my-branch
+    $ python -m benchmarks run --pages 500 -o after.json
+    $ python -m benchmarks compare before.json after.json
+"""
@@ -0,0 +1,284 @@
+"""
+Command-line interface for the benchmarks.
+
+    python -m benchmarks generate [options] DIRECTORY
+    python -m benchmarks run [options] [-o RESULTS]
+    python -m benchmarks compare OLD NEW
+    python -m benchmarks startup [--budget MS]
+"""
+
+from . import sitegen
+
+import argparse
+import io
+import json
+import os
+import platform
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ('cold', 'warm', 'change')
+RESULTS_VERSION = 1
+
+
+def python_env():
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+  return env
+
+
+def run_statigen(directory, args):
+  """
+  Runs #statigen.main() with *args* in a new interpreter in the project
+  *directory*. Returns the wall time in seconds, the peak RSS of the process
+  in KiB (#None if it can not be determined) and the number of files that
+  were written to the build directory (excluding the cache directory).
+  """
+
+  env = python_env()
+  command = [sys.executable, '-c',
+    'import sys, statigen; sys.exit(statigen.main(sys.argv[1:]))'] + args
+  started_ns = time.time_ns()
+  start = time.perf_counter()
+  proc = subprocess.Popen(command, cwd=directory, env=env,
+    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  if hasattr(os, 'wait4'):
+    stderr = proc.stderr.read()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    peak_rss = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+      peak_rss //= 1024
+  else:
+    stderr = proc.communicate()[1]
+    peak_rss = None
+  seconds = time.perf_counter() - start
+  if proc.returncode != 0:
+    raise RuntimeError('statigen failed in {}:\n{}'.format(directory, stderr.decode()))
+
+  build_directory = os.path.join(directory, 'build')
+  files_written = 0
+  for root, dirs, files in os.walk(build_directory):
+    if root == build_directory and '.statigen' in dirs:
+      dirs.remove('.statigen')
+    for name in files:
+      if os.stat(os.path.join(root, name)).st_ctime_ns >= started_ns:
+        files_written += 1
+
+  return {'seconds': seconds, 'peak_rss_kib': peak_rss, 'files_written': files_written}
+
+
+def change_file(filename, counter):
+  with io.open(filename, 'a', encoding='utf8') as fp:
+    fp.write('\nThis paragraph was appended by change number {}.\n'.format(counter))
+
+
+def summarize(runs):
+  seconds = [x['seconds'] for x in runs]
+  rss = [x['peak_rss_kib'] for x in runs if x['peak_rss_kib'] is not None]
+  return {
+    'runs': runs,
+    'seconds_median': statistics.median(seconds),
+    'seconds_min': min(seconds),
+    'peak_rss_kib': max(rss) if rss else None,
+    'files_written': runs[-1]['files_written'],
+  }
+
+
+def benchmark(template, params, args, repeat, workdir):
+  """
+  Generates the site for *template* and measures a cold build, a warm
+  rebuild without changes and a rebuild after a change to the body of a
+  single content file, *repeat* times each.
+  """
+
+  directory = os.path.join(workdir, template)
+  files = sitegen.GENERATORS[template](directory, params)
+  changed_file = files[len(files) // 2]
+  results = {x: [] for x in SCENARIOS}
+  for i in range(repeat):
+    shutil.rmtree(os.path.join(directory, 'build'), ignore_errors=True)
+    results['cold'].append(run_statigen(directory, args))
+    results['warm'].append(run_statigen(directory, args))
+    change_file(changed_file, i)
+    results['change'].append(run_statigen(directory, args))
+  return {k: summarize(v) for k, v in results.items()}
+
+
+def git_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+      stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def params_from_args(args):
+  return sitegen.Params(pages=args.pages, depth=args.depth, posts=args.posts,
+    body_size=args.body_size, links=args.links, code_blocks=args.code_blocks,
+    assets=args.assets, asset_size=args.asset_size, seed=args.seed)
+
+
+def cmd_generate(args):
+  params = params_from_args(args)
+  for template in args.templates:
+    directory = os.path.join(args.directory, template)
+    sitegen.GENERATORS[template](directory, params)
+    print('generated {}'.format(directory))
+
+
+def cmd_run(args):
+  params = params_from_args(args)
+  statigen_args = shlex.split(args.args)
+  report = {
+    'version': RESULTS_VERSION,
+    'revision': git_revision(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'params': params.to_json(),
+    'args': statigen_args,
+    'repeat': args.repeat,
+    'results': {},
+  }
+  workdir = tempfile.mkdtemp(prefix='statigen-bench-')
+  try:
+    for template in args.templates:
+      print('benchmarking {} ...'.format(template))
+      results = benchmark(template, params, statigen_args, args.repeat, workdir)
+      report['results'][template] = results
+      for scenario in SCENARIOS:
+        data = results[scenario]
+        print('  {:<7} {:>8.3f}s (min {:.3f}s)  {:>8} KiB  {:>6} file(s) written'.format(
+          scenario, data['seconds_median'], data['seconds_min'],
+          data['peak_rss_kib'], data['files_written']))
+  finally:
+    if args.keep:
+      print('kept sites in {}'.format(workdir))
+    else:
+      shutil.rmtree(workdir, ignore_errors=True)
+
+  if args.output:
+    with io.open(args.output, 'w', encoding='utf8') as fp:
+      json.dump(report, fp, indent=2)
+    print('results written to {}'.format(args.output))
+
+
+def cmd_compare(args):
+  with io.open(args.old, encoding='utf8') as fp:
+    old = json.load(fp)
+  with io.open(args.new, encoding='utf8') as fp:
+    new = json.load(fp)
+  if old['params'] != new['params'] or old['args'] != new['args']:
+    print('warning: the results were measured with different parameters')
+  print('{:<6} {:<7} {:>10} {:>10} {:>8}'.format('site', 'build', 'old', 'new', 'change'))
+  for template in sorted(set(old['results']) & set(new['results'])):
+    for scenario in SCENARIOS:
+      a = old['results'][template][scenario]['seconds_median']
+      b = new['results'][template][scenario]['seconds_median']
+      print('{:<6} {:<7} {:>9.3f}s {:>9.3f}s {:>+7.1f}%'.format(
+        template, scenario, a, b, 100.0 * (b - a) / a))
+
+
+def time_python(code, repeat, cwd=None):
+  """
+  Runs *code* in a new interpreter *repeat* times and returns the median
+  wall time in milliseconds.
+  """
+
+  env = python_env()
+  times = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, '-c', code], cwd=cwd, env=env,
+      stdout=subprocess.DEVNULL)
+    times.append((time.perf_counter() - start) * 1000)
+  return statistics.median(times)
+
+
+def cmd_startup(args):
+  """
+  Measures the startup time of statigen in a new interpreter. The time of
+  `statigen --version` minus the time of an empty interpreter is compared
+  against the budget and the command fails if it is exceeded.
+  """
+
+  workdir = tempfile.mkdtemp(prefix='statigen-bench-')
+  try:
+    params = sitegen.Params(pages=3, depth=1, assets=1, asset_size=1024)
+    sitegen.generate_docs_site(workdir, params)
+    results = [
+      ('interpreter', time_python('pass', args.repeat)),
+      ('import', time_python('import statigen', args.repeat)),
+      ('--version', time_python('import statigen\ntry: statigen.main(["--version"])\n'
+                                'except SystemExit: pass', args.repeat)),
+      ('small site', time_python('import statigen; statigen.main([])', args.repeat, workdir)),
+    ]
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+
+  for name, ms in results:
+    print('  {:<12} {:>8.1f} ms'.format(name, ms))
+  overhead = results[2][1] - results[0][1]
+  print('statigen --version takes {:.1f} ms on top of the interpreter (budget: {} ms)'.format(
+    overhead, args.budget))
+  if overhead > args.budget:
+    print('error: the startup budget is exceeded')
+    sys.exit(1)
+
+
+def get_argument_parser():
+  parser = argparse.ArgumentParser(prog='python -m benchmarks')
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+
+  site = argparse.ArgumentParser(add_help=False)
+  site.add_argument('--template', dest='templates', action='append',
+    choices=sorted(sitegen.GENERATORS), help='The site template to benchmark. Can be specified multiple times. Default: all')
+  site.add_argument('--pages', type=int, default=100, help='Number of pages of the docs site. Default: 100')
+  site.add_argument('--depth', type=int, default=3, help='Maximum depth of the docs page tree. Default: 3')
+  site.add_argument('--posts', type=int, default=100, help='Number of posts of the blog site. Default: 100')
+  site.add_argument('--body-size', type=int, default=4000, help='Approximate size of a page body in bytes. Default: 4000')
+  site.add_argument('--links', type=int, default=5, help='Number of [[ref]] links per page. Default: 5')
+  site.add_argument('--code-blocks', type=int, default=1, help='Number of fenced code blocks per page. Default: 1')
+  site.add_argument('--assets', type=int, default=20, help='Number of asset files. Default: 20')
+  site.add_argument('--asset-size', type=int, default=16384, help='Size of an asset file in bytes. Default: 16384')
+  site.add_argument('--seed', type=int, default=0, help='Seed for the site generator. Default: 0')
+
+  generate = subparsers.add_parser('generate', parents=[site], help='Generate the synthetic sites.')
+  generate.add_argument('directory')
+  generate.set_defaults(func=cmd_generate)
+
+  run = subparsers.add_parser('run', parents=[site], help='Run the benchmarks.')
+  run.add_argument('-n', '--repeat', type=int, default=3, help='Number of times to run each build. Default: 3')
+  run.add_argument('-a', '--args', default='-i', help='Arguments for statigen. Default: -i')
+  run.add_argument('-o', '--output', help='Write the results as JSON to this file.')
+  run.add_argument('-k', '--keep', action='store_true', help='Keep the generated sites.')
+  run.set_defaults(func=cmd_run)
+
+  compare = subparsers.add_parser('compare', help='Compare the results of two runs.')
+  compare.add_argument('old')
+  compare.add_argument('new')
+  compare.set_defaults(func=cmd_compare)
+
+  startup = subparsers.add_parser('startup', help='Measure the startup time and check it against a budget.')
+  startup.add_argument('-n', '--repeat', type=int, default=10, help='Number of times to run each command. Default: 10')
+  startup.add_argument('--budget', type=float, default=75, help='Maximum time in milliseconds that statigen --version may take on top of the interpreter startup. Default: 75')
+  startup.set_defaults(func=cmd_startup)
+  return parser
+
+
+def main(argv=None):
+  args = get_argument_parser().parse_args(argv)
+  if getattr(args, 'templates', 1) is None:
+    args.templates = sorted(sitegen.GENERATORS)
+  args.func(args)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,190 @@
+"""
+Generates synthetic Statigen projects. The output only depends on the
+parameters and the *seed*, so the same site is generated for every commit
+that is benchmarked.
+"""
+
+import datetime
+import io
+import os
+import random
+
+WORDS = '''
+  lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod
+  tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam
+  quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo
+  consequat duis aute irure in reprehenderit voluptate velit esse cillum
+  fugiat nulla pariatur excepteur sint occaecat cupidatat non proident sunt
+  culpa qui officia deserunt mollit anim id est laborum
+'''.split()
+
+CODE = '''\
+```python
+def fibonacci(n):
+  """Returns the *n*-th Fibonacci number."""
+
+  a, b = 0, 1
+  for _ in range(n):
+    a, b = b, a + b
+  return a
+```
+'''
+
+
+class Params(object):
+  """
+  The parameters of a synthetic site.
+
+  * *pages*: The number of pages of a `default/docs` site.
+  * *depth*: The maximum depth of the page tree of a `default/docs` site.
+  * *posts*: The number of posts of a `default/blog` site.
+  * *body_size*: The approximate size of the body of a page in bytes.
+  * *links*: The number of `[[ref]]` links per page.
+  * *code_blocks*: The number of fenced code blocks per page.
+  * *assets*: The number of asset files.
+  * *asset_size*: The size of a single asset file in bytes.
+  """
+
+  def __init__(self, pages=100, depth=3, posts=100, body_size=4000, links=5,
+               code_blocks=1, assets=20, asset_size=16384, seed=0):
+    self.pages = pages
+    self.depth = depth
+    self.posts = posts
+    self.body_size = body_size
+    self.links = links
+    self.code_blocks = code_blocks
+    self.assets = assets
+    self.asset_size = asset_size
+    self.seed = seed
+
+  def to_json(self):
+    return dict(vars(self))
+
+
+def _write(filename, text):
+  os.makedirs(os.path.dirname(filename), exist_ok=True)
+  with io.open(filename, 'w', encoding='utf8') as fp:
+    fp.write(text)
+
+
+def _write_assets(directory, names, size, rng):
+  os.makedirs(directory, exist_ok=True)
+  for name in names:
+    with open(os.path.join(directory, name), 'wb') as fp:
+      fp.write(rng.getrandbits(size * 8).to_bytes(size, 'little'))
+
+
+def _page(rng, params, config, refs, images=()):
+  """
+  Returns the source of a page with the TOML front matter *config* and a
+  body with links to the content names in *refs* and the *images*.
+  """
+
+  lines = ['+++']
+  for key, value in config.items():
+    if isinstance(value, str):
+      value = '"{}"'.format(value)
+    lines.append('{} = {}'.format(key, value))
+  lines.append('+++')
+  lines.append('')
+
+  paragraphs = []
+  size = 0
+  while size < params.body_size:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(40, 120))]
+    paragraph = ' '.join(words).capitalize() + '.'
+    paragraphs.append(paragraph)
+    size += len(paragraph)
+  for i in range(params.links if refs else 0):
+    index = rng.randrange(len(paragraphs))
+    paragraphs[index] += ' See [[{}]].'.format(rng.choice(refs))
+  for i in range(params.code_blocks):
+    paragraphs.insert(rng.randrange(len(paragraphs) + 1), CODE)
+  for image in images:
+    paragraphs.insert(rng.randrange(len(paragraphs) + 1), '![{0}]({0})'.format(image))
+  for i in range(0, len(paragraphs), 4):
+    paragraphs[i] = '## {}\n\n{}'.format(rng.choice(WORDS).capitalize(), paragraphs[i])
+
+  return '\n'.join(lines) + '\n\n'.join(paragraphs) + '\n'
+
+
+def generate_docs_site(directory, params):
+  """
+  Generates a project for the `default/docs` site template in *directory*.
+  Returns the list of the generated content filenames.
+  """
+
+  rng = random.Random(params.seed)
+  _write(os.path.join(directory, '.statigen.toml'),
+    '[statigen]\ntemplate = "default/docs"\nurlFormat = "file"\n\n'
+    '[site]\ntitle = "Synthetic Docs"\n')
+
+  # Every page except the index is attached to a random page above the
+  # maximum depth, or to the root.
+  names = ['index']
+  depths = {'index': 0}
+  for i in range(1, params.pages):
+    parents = [x for x in names if x != 'index' and depths[x] < params.depth]
+    parent = rng.choice(parents + [None] * max(1, len(parents) // 4))
+    name = 'page-{}'.format(i) if parent is None else '{}/page-{}'.format(parent, i)
+    names.append(name)
+    depths[name] = 1 if parent is None else depths[parent] + 1
+
+  files = []
+  for i, name in enumerate(names):
+    config = {'title': 'Page {}'.format(i), 'ordering': i}
+    filename = os.path.join(directory, name + '.md')
+    _write(filename, _page(rng, params, config, names))
+    files.append(filename)
+
+  _write_assets(os.path.join(directory, 'static'),
+    ['asset-{}.bin'.format(i) for i in range(params.assets)], params.asset_size, rng)
+  return files
+
+
+def generate_blog_site(directory, params):
+  """
+  Generates a project for the `default/blog` site template in *directory*.
+  The assets are distributed over the posts and embedded as images. Returns
+  the list of the generated content filenames.
+  """
+
+  rng = random.Random(params.seed)
+  _write(os.path.join(directory, '.statigen.toml'),
+    '[statigen]\ntemplate = "default/blog"\nurlFormat = "file"\n\n'
+    '[site]\ntitle = "Synthetic Blog"\nsubtitle = "a synthetic blog"\n')
+
+  files = []
+  for i, name in enumerate(['home', 'blog', 'about']):
+    config = {'title': name.capitalize(), 'ordering': i}
+    if name == 'blog':
+      config.update({'displayPostsFrom': 'blog', 'url': '/blog'})
+    filename = os.path.join(directory, name + '.md')
+    _write(filename, _page(rng, params, config, []))
+    files.append(filename)
+
+  date = datetime.date(2018, 1, 1)
+  names = []
+  for i in range(params.posts):
+    names.append('{}-post-{}'.format(date + datetime.timedelta(days=i), i))
+  refs = ['blog/' + x for x in names]
+  assets = {}
+  for i in range(params.assets if names else 0):
+    assets.setdefault(names[i % len(names)], []).append('image-{}.png'.format(i))
+
+  for i, name in enumerate(names):
+    config = {'title': 'Post {}'.format(i), 'date': name[:10]}
+    filename = os.path.join(directory, 'blog', name + '.md')
+    _write(filename, _page(rng, params, config, refs, assets.get(name, ())))
+    files.append(filename)
+    if name in assets:
+      _write_assets(os.path.join(directory, 'blog', name), assets[name],
+        params.asset_size, rng)
+
+  return files
+
+
+GENERATORS = {
+  'docs': generate_docs_site,
+  'blog': generate_blog_site,
+}
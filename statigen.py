@@ -26,24 +26,29 @@ Statigen is a minimal, customizable static site generator.
 __version__ = '1.0.1'
 __author__ = 'Niklas Rosenstein <rosensteinniklas@gmail.com>'
 
-from distutils.dir_util import copy_tree
-from nr.types.map import ChainMap
-from urllib.parse import urlparse
-
 import abc
-import bs4
+import atexit
+import binascii
+import collections
+import collections.abc
+import contextlib
+import datetime
+import functools
+import hashlib
 import io
-import jinja2
+import json
 import nr.fs as path
-import nr.markdown
 import os
 import posixpath
 import re
 import shutil
 import six
 import sys
-import toml
+import tempfile
+import threading
+import time
 import types
+import weakref
 
 ##
 # Abstract Interfaces
@@ -63,6 +68,27 @@ class ContentLoader(six.with_metaclass(abc.ABCMeta)):
     Load all content in the specified *directory*.
     """
 
+  def reload_content(self, context, content):
+    """
+    Load the specified #Content object again from its source and return a
+    new #Content object. Returns #None if this is not supported, which is the
+    default.
+    """
+
+    return None
+
+  def has_directory(self, context, directory):
+    """
+    Returns #True if *directory* exists and content can be loaded from it.
+    """
+
+    return path.isdir(directory)
+
+  def build_started(self, context):
+    """
+    Called by #Context.build() before the site template is rendered.
+    """
+
 
 class ContentRenderer(six.with_metaclass(abc.ABCMeta)):
 
@@ -82,6 +108,22 @@ class ContentRenderer(six.with_metaclass(abc.ABCMeta)):
     Render the #Content object *content* to HTML.
     """
 
+  def build_started(self, context):
+    """
+    Called by #Context.build() before the site template is rendered.
+    """
+
+  def build_finished(self, context):
+    """
+    Called by #Context.build() after the site was built.
+    """
+
+  def release_content(self, context, content):
+    """
+    Called by #Content.release() to release the data that the renderer
+    stores for *content*, eg. the rendered HTML.
+    """
+
 
 class TemplateRenderer(six.with_metaclass(abc.ABCMeta)):
 
@@ -92,6 +134,18 @@ class TemplateRenderer(six.with_metaclass(abc.ABCMeta)):
     may search the template in the #Context.template_directory.
     """
 
+  def get_template_dependencies(self, context, template):
+    """
+    Return a list of the filenames that the *template* depends on, including
+    the file of the template itself. Files that do not exist may be included
+    as well if their creation would change the result (eg. when they would
+    take precedence over another template). If the dependencies can not be
+    determined, #None should be returned, in which case pages that use the
+    template are always rendered in incremental builds.
+    """
+
+    return None
+
 
 class SiteTemplate(six.with_metaclass(abc.ABCMeta)):
   """
@@ -129,27 +183,140 @@ class SiteTemplate(six.with_metaclass(abc.ABCMeta)):
     This method should do calls to #Context.render() to build the static site.
     """
 
+  def get_render_executor(self, context):
+    """
+    Return the kind of worker pool that pages are rendered with if the build
+    uses more than one job. Can be `'process'` (default) or `'thread'`. The
+    process pool is forked after the site template's #render() method returned
+    and thus inherits all state, but changes made while rendering a page are
+    not visible to the other pages. Pages are rendered in threads instead if
+    other threads are running when the pool would be forked, eg. in watch
+    mode.
+    """
+
+    return 'process'
+
+
+class PostProcessor(six.with_metaclass(abc.ABCMeta)):
+  """
+  Post-processes the pages rendered by #Context.render() and the files copied
+  by #Context.copy() before they end up in the build directory. Post
+  processors are called from worker threads and processes.
+  """
+
+  def process(self, context, filename, data):
+    """
+    Return the bytes that are written to *filename* instead of *data*. The
+    default implementation returns *data* unchanged.
+    """
+
+    return data
+
+  def get_derived_files(self, context, filename):
+    """
+    Return a list of `(filename, func)` tuples for the files that are derived
+    from *filename* (eg. a compressed copy), where *func* is called with the
+    final data of *filename* and returns the data of the derived file.
+    Derived files are only produced again if the data of *filename* changed.
+    """
+
+    return []
+
 
 ##
 # Concrete Implementations
 ##
 
 class MarkdownTomlContentLoader(ContentLoader):
+  """
+  Loads Markdown files with TOML front matter. The content directory is
+  scanned once per build into a #ContentIndex, and the front matter of all
+  files in the index is parsed in a thread pool up front. Disable this with
+  the `statigen.contentIndex` option to list directories and read files as
+  they are requested. If the build uses an #IOPipeline, the files are read
+  completely by the pipeline while the site template is already running.
+  """
+
+  def __init__(self):
+    self._indexes = weakref.WeakKeyDictionary()
+    self._lock = threading.Lock()
+
+  def build_started(self, context):
+    self._indexes.pop(context, None)
+
+  def get_index(self, context):
+    """
+    Returns the #ContentIndex of the content directory for the current build,
+    or #None if the `statigen.contentIndex` option is disabled.
+    """
 
-  def _load_file(self, context, filename, name, override_config=None):
-    with io.open(filename, encoding=context.content_encoding) as fp:
-      content = fp.read()
-    if content.lstrip().startswith('+++'):
-      index = content.find('+++') + 3
-      lines = content[index:].split('\n')
-      toml_content = ''
-      while lines and lines[0].strip() != '+++':
-        toml_content += lines.pop(0) + '\n'
-      lines.pop(0)
-      content = '\n'.join(lines)
-      config = toml.loads(toml_content)
+    with self._lock:
+      if context not in self._indexes:
+        index = None
+        if context.config.get('statigen.contentIndex', True):
+          exclude = [context.config['statigen.buildDirectory'], context.get_cache_directory()]
+          index = ContentIndex(context.config['statigen.contentDirectory'], '.md', exclude)
+          if context.io_pipeline is not None:
+            # Bodies are only read up front if they may stay in memory.
+            read = self._read_front_matter if context.low_memory else self._read_file
+            index.prefetch(functools.partial(read, context), context.io_pipeline)
+          else:
+            index.prefetch(functools.partial(self._read_front_matter, context))
+        self._indexes[context] = index
+      return self._indexes[context]
+
+  def has_directory(self, context, directory):
+    index = self.get_index(context)
+    if index is None:
+      return path.isdir(directory)
+    return index.isdir(directory)
+
+  def _read_front_matter(self, context, filename):
+    """
+    Reads the TOML front matter enclosed in `+++` lines from the beginning of
+    *filename*. The file is only read up to the end of the front matter.
+    Returns the parsed configuration and the position in the file where the
+    body starts.
+    """
+
+    import toml
+    with context.profile('front-matter'), \
+        io.open(filename, encoding=context.content_encoding) as fp:
+      line = fp.readline()
+      while line and not line.strip():
+        line = fp.readline()
+      if not line.lstrip().startswith('+++'):
+        return {}, 0
+      line = line.lstrip()[3:]
+      toml_lines = []
+      while line.strip() != '+++':
+        if not line:
+          raise ValueError('{}: front matter is not terminated with +++'.format(filename))
+        toml_lines.append(line)
+        line = fp.readline()
+      return toml.loads(''.join(toml_lines)), fp.tell()
+
+  def _read_body(self, context, filename, offset):
+    with context.profile('load'), \
+        io.open(filename, encoding=context.content_encoding) as fp:
+      fp.seek(offset)
+      return fp.read()
+
+  def _read_file(self, context, filename):
+    config, offset = self._read_front_matter(context, filename)
+    return config, offset, self._read_body(context, filename, offset)
+
+  def _load_file(self, context, filename, name, override_config=None, sources=None):
+    sources = (sources or []) + [filename]
+    index = self.get_index(context)
+    data = index.pop_data(filename) if index is not None else None
+    if data is None:
+      data = self._read_front_matter(context, filename)
+    config, offset = data[:2]
+    if len(data) > 2:
+      content = data[2]
     else:
-      config = {}
+      content = functools.partial(self._read_body, context, filename, offset)
     assets = path.rmvsuffix(filename)
 
     if override_config:
@@ -158,27 +325,320 @@ class MarkdownTomlContentLoader(ContentLoader):
     if 'contentFrom' in config:
       filename = os.path.join(os.path.dirname(filename), config['contentFrom'])
       del config['contentFrom']
-      return self._load_file(context, filename, name, config)
+      return self._load_file(context, filename, name, config, sources)
 
-    return Content(context, filename, assets, name, config, content)
+    content_type = _CompactContent if context.low_memory else Content
+    return content_type(context, filename, assets, name, config, content, sources)
 
   def load_content(self, context, name):
     if path.isabs(name):
-      filename = name
+      filename = path.canonical(name)
     else:
       content_dir = context.config['statigen.contentDirectory']
-      filename = path.canonical(name + '.md', content_dir)
-    return self._load_file(context, filename, path.base(name))
+      filename = path.canonical(path.join(content_dir, name + '.md'))
+    content = context.content_registry.get(filename)
+    if content is None:
+      content = self._load_file(context, filename, path.base(name))
+    return content
+
+  def reload_content(self, context, content):
+    return self._load_file(context, content.sources[0], content.name)
 
   def load_content_from_directory(self, context, directory):
-    for filename in os.listdir(directory):
+    index = self.get_index(context)
+    if index is not None:
+      filenames = index.listdir(directory)
+    else:
+      filenames = os.listdir(directory)
+    for filename in filenames:
       if filename.endswith('.md'):
         name = filename[:-3]
-        filename = path.join(directory, filename)
-        yield self._load_file(context, filename, name)
+        filename = path.canonical(path.join(directory, filename))
+        content = context.content_registry.get(filename)
+        if content is None:
+          content = self._load_file(context, filename, name)
+        yield content
 
 
 class MarkdownJinjaContentRenderer(ContentRenderer):
+  """
+  Renders Markdown content after rewriting links to other content and
+  rendering it as a Jinja template.
+
+  If the `statigen.markdownCache` option is enabled, the rendered HTML and
+  table of contents are cached on disk in the `markdown/` subdirectory of the
+  #Context.get_cache_directory(). Entries are keyed by the Markdown source
+  after links were resolved and Jinja was rendered, thus covering changes to
+  the content, link targets and template variables alike. The cache size is
+  limited to `statigen.markdownCacheSize` MiB (default: 64).
+
+  Fenced code blocks with a language are highlighted with Pygments unless the
+  `statigen.highlightCode` option is disabled. The highlighting extension
+  caches the highlighted code blocks by language, formatter
+  options and code for the duration of a build, and on disk in the
+  `highlight/` subdirectory if the `statigen.highlightCache` option is
+  enabled (limited to `statigen.highlightCacheSize` MiB, default: 32).
+  Lexers are looked up once per language.
+  """
+
+  #: Increment when a change to the renderer changes its output, to invalidate
+  #: the Markdown cache.
+  VERSION = 2
+
+  def __init__(self):
+    self._caches = weakref.WeakKeyDictionary()
+    self._spill_caches = weakref.WeakKeyDictionary()
+    self._released = weakref.WeakKeyDictionary()
+    self._highlight_caches = weakref.WeakKeyDictionary()
+    self._highlighted = weakref.WeakKeyDictionary()
+    self._lexers = {}
+
+  def get_markdown_cache(self, context):
+    """
+    Returns the #DiskCache for rendered Markdown or #None if the cache is
+    disabled.
+    """
+
+    if context not in self._caches:
+      cache = None
+      if context.config.get('statigen.markdownCache', False):
+        directory = path.join(context.get_cache_directory(), 'markdown')
+        max_size = context.config.get('statigen.markdownCacheSize', 64)
+        cache = DiskCache(directory, max_size * 1024 * 1024)
+      self._caches[context] = cache
+    return self._caches[context]
+
+  def get_highlight_cache(self, context):
+    """
+    Returns the #DiskCache for highlighted code blocks or #None if the cache
+    is disabled.
+    """
+
+    if context not in self._highlight_caches:
+      cache = None
+      if context.config.get('statigen.highlightCache', False):
+        directory = path.join(context.get_cache_directory(), 'highlight')
+        max_size = context.config.get('statigen.highlightCacheSize', 32)
+        cache = DiskCache(directory, max_size * 1024 * 1024)
+      self._highlight_caches[context] = cache
+    return self._highlight_caches[context]
+
+  def get_markdown_extensions(self, context):
+    """
+    Returns the extensions for the #nr.markdown.Markdown renderer. Code is
+    highlighted by a #_HighlightExtension in place of the `pygments` extension.
+    """
+
+    import nr.markdown
+    extensions = [x for x in nr.markdown.Markdown.DEFAULT_EXTENSIONS if x != 'pygments']
+    if context.config.get('statigen.highlightCode', True):
+      extensions.append(_HighlightExtension(self, context))
+    return extensions
+
+  def get_lexer(self, lang):
+    """
+    Returns the Pygments lexer for the language *lang*, or #None if there is
+    none. Lexers are only looked up once per language.
+    """
+
+    try:
+      return self._lexers[lang]
+    except KeyError:
+      pass
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+    try:
+      lexer = get_lexer_by_name(lang, stripall=True)
+    except ClassNotFound:
+      lexer = None
+    self._lexers[lang] = lexer
+    return lexer
+
+  def highlight_code(self, context, code, lang, options):
+    """
+    Highlights the *code* in the language *lang* with Pygments and an
+    #HtmlFormatter created with *options*. Returns #None if there is no lexer
+    for the language.
+    """
+
+    lexer = self.get_lexer(lang)
+    if lexer is None:
+      return None
+
+    import pygments
+    key = fingerprint(pygments.__version__, lang, options,
+                      hashlib.sha1(code.encode('utf8')).hexdigest())
+    highlighted = self._highlighted.setdefault(context, {})
+    try:
+      return highlighted[key]
+    except KeyError:
+      pass
+    cache = self.get_highlight_cache(context)
+    result = cache.get(key) if cache is not None else None
+    if result is None:
+      from pygments.formatters import HtmlFormatter
+      with context.profile('highlight'):
+        result = '\n' + pygments.highlight(code, lexer, HtmlFormatter(**options))
+      if cache is not None:
+        cache.set(key, result)
+    highlighted[key] = result
+    return result
+
+  def get_spill_cache(self, context):
+    """
+    Returns the #DiskCache that rendered HTML is moved to when it is
+    released in a #Context.low_memory build, or #None.
+    """
+
+    if not context.low_memory:
+      return None
+    if context not in self._spill_caches:
+      directory = path.join(context.get_cache_directory(), 'spill')
+      self._spill_caches[context] = DiskCache(directory, None)
+    return self._spill_caches[context]
+
+  def build_started(self, context):
+    # Content may be kept between builds by the ContentRegistry, but the
+    # rendered HTML depends on other content and must be refreshed.
+    for content in context.content_registry:
+      self._discard(content)
+    self._highlighted.pop(context, None)
+    self._released.pop(context, None)
+    spill = self.get_spill_cache(context)
+    if spill is not None:
+      spill.clear()
+
+  @staticmethod
+  def _discard(content):
+    for name in ('_mdcache', '_mdtoc'):
+      try:
+        delattr(content, name)
+      except AttributeError:
+        pass
+
+  def release_content(self, context, content):
+    # Most content is only used by its own page. The HTML is only spilled
+    # once the content was rendered again after it was released, ie. when
+    # another page (eg. a listing or a parent) uses it as well.
+    spill = self.get_spill_cache(context)
+    if spill is not None and hasattr(content, '_mdcache'):
+      key = fingerprint(content.sources)
+      released = self._released.setdefault(context, set())
+      if key in released:
+        spill.set(key, (content._mdcache, content._mdtoc))
+      else:
+        released.add(key)
+    self._discard(content)
+
+  def build_finished(self, context):
+    for cache in (self.get_markdown_cache(context), self.get_highlight_cache(context)):
+      if cache is not None:
+        cache.trim()
+
+  #: The patterns of the references that are replaced by #rewrite_links(),
+  #: in the order in which they are processed.
+  LINK_PATTERNS = [
+    # URL references in the form of [x]: y
+    r'(\[[^\]]+?]:)(.*)',
+    # Inline references in the form of [x](y)
+    r'(\[[^\]]*?]\()([^\)]+?)(\))',
+    # src="" attributes on img nodes.
+    r'(<img.*?src=")([^"]+?)(".*?>)',
+    # [[content]] references.
+    r'(\[\[)([^\]]+?)(\]\])',
+  ]
+
+  _link_passes = [re.compile(x) for x in LINK_PATTERNS]
+  _link_tokenizer = re.compile('|'.join('({})'.format(x) for x in LINK_PATTERNS))
+  # Maps the index of the outer group in the #_link_tokenizer to the index
+  # of the pattern and the number of its groups.
+  _link_groups = {1: (0, 2), 4: (1, 3), 8: (2, 3), 12: (3, 3)}
+  # Fenced code blocks (until the closing fence or the end of the body) and
+  # code spans, which may span lines but not paragraphs.
+  _code_pattern = re.compile(
+    r'^[ \t]*(`{3,}|~{3,})[^\n]*\n.*?(?:^[ \t]*\1[ \t]*$|\Z)'
+    r'|(`+)(?!`)(?:(?!\n[ \t]*\n).)+?(?<!`)\2(?!`)', re.M | re.S)
+
+  def rewrite_links(self, context, body):
+    """
+    Rewrites relative URLs in reference links, inline links and `<img src>`
+    attributes to URLs relative to the current page and replaces `[[name]]`
+    references with Markdown links to the named content.
+
+    All kinds of references are replaced in a single pass over the *body*.
+    If references are nested or overlap (eg. an `<img>` in the text of a
+    link), the result depends on the order in which the kinds of references
+    are processed. Such a body is processed with one pass per pattern in the
+    order of #LINK_PATTERNS instead.
+
+    Fenced code blocks and code spans are left as they are.
+    """
+
+    from urllib.parse import urlparse
+
+    def rewrite(url):
+      ref = url.strip()
+      if ref and not urlparse(ref).scheme and not ref.startswith('{{') \
+          and not ref.startswith('#'):
+        return context.content_reference_to_url(ref)
+      return url
+
+    def reference(name):
+      content = context.load_content(name)
+      return '[{}]({})'.format(content.config.get('title', content.name),
+        context.content_reference_to_url(name))
+
+    parts = []
+    index = 0
+    for match in self._code_pattern.finditer(body):
+      parts.append(self._rewrite_links_in_text(body[index:match.start()], rewrite, reference))
+      parts.append(match.group(0))
+      index = match.end()
+    parts.append(self._rewrite_links_in_text(body[index:], rewrite, reference))
+    return ''.join(parts)
+
+  def _rewrite_links_in_text(self, body, rewrite, reference):
+    tokens = []
+    for match in self._link_tokenizer.finditer(body):
+      kind, count = self._link_groups[match.lastindex]
+      groups = match.groups()[match.lastindex:match.lastindex + count]
+      if not self._is_simple_link(kind, groups):
+        return self._rewrite_links_in_passes(body, rewrite, reference)
+      tokens.append((match.start(), match.end(), kind, groups))
+
+    parts = []
+    index = 0
+    for start, end, kind, groups in tokens:
+      parts.append(body[index:start])
+      if kind == 3:
+        parts.append(reference(groups[1]))
+      else:
+        parts.append(groups[0] + rewrite(groups[1]) + ''.join(groups[2:]))
+      index = end
+    parts.append(body[index:])
+    return ''.join(parts)
+
+  @staticmethod
+  def _is_simple_link(kind, groups):
+    # A reference can only be matched by another pattern (or a pattern that
+    # is processed later can only match across the replaced URL) if it
+    # contains characters that start or end another kind of reference.
+    if kind in (0, 1):
+      return '[' not in groups[0][1:] and '<' not in groups[0] \
+        and not any(c in groups[1] for c in '[]<')
+    elif kind == 2:
+      return not any(c in ''.join(groups) for c in '[]')
+    else:
+      return '[' not in groups[1] and '<' not in groups[1]
+
+  def _rewrite_links_in_passes(self, body, rewrite, reference):
+    def callback(m):
+      groups = list(m.groups())
+      groups[1] = rewrite(groups[1])
+      return ''.join(groups)
+    for regex in self._link_passes[:3]:
+      body = regex.sub(callback, body)
+    return self._link_passes[3].sub(lambda m: reference(m.group(2)), body)
 
   def get_table_of_contents(self, context, content):
     self.render_content(context, content)
@@ -188,55 +648,158 @@ class MarkdownJinjaContentRenderer(ContentRenderer):
     if hasattr(content, '_mdcache'):
       return content._mdcache
 
-    body = content.body
+    spill = self.get_spill_cache(context)
+    if spill is not None:
+      cached = spill.get(fingerprint(content.sources))
+      if cached is not None:
+        content._mdcache, content._mdtoc = cached
+        return content._mdcache
 
-    def callback(m):
-      groups = list(m.groups())
-      url = groups[1].strip()
-      if url and not urlparse(url).scheme and not url.startswith('{{') \
-          and not url.startswith('#'):
-        groups[1] = context.content_reference_to_url(url)
-      return ''.join(groups)
+    import jinja2, nr.markdown
 
-    # Update URL references in the form of [x]: y
-    body = re.sub(r'(\[[^\]]+?]:)(.*)', callback, body)
+    body = content.body
+    with context.profile('links'):
+      body = self.rewrite_links(context, body)
 
-    # Update inline references in the form of [x](y)
-    body = re.sub(r'(\[[^\]]*?]\()([^\)]+?)(\))', callback, body)
+    # Render the body with Jinja2.
+    with context.profile('jinja'):
+      env = jinja2.Environment()
+      template = env.from_string(body)
+      body = template.render(context.template_vars)
+
+    with context.profile('markdown'):
+      cache = self.get_markdown_cache(context)
+      if cache is not None:
+        key = fingerprint(self.VERSION, __version__,
+          getattr(nr.markdown, '__version__', None),
+          context.config.get('statigen.highlightCode', True), body)
+        cached = cache.get(key)
+        if cached is not None:
+          content._mdcache, content._mdtoc = cached
+          return content._mdcache
+
+      md = nr.markdown.Markdown(extensions=self.get_markdown_extensions(context))
+      content._mdcache = md(body)
+      content._mdtoc = md.toc
+      if cache is not None:
+        cache.set(key, (content._mdcache, content._mdtoc))
+    return content._mdcache
 
-    # Update src="" attributes on img nodes.
-    body = re.sub(r'(<img.*?src=")([^"]+?)(".*?>)', callback, body)
 
-    # Allow [[content]] references.
-    def callback(m):
-      groups = m.groups()
-      content = context.load_content(groups[1])
-      return '[{}]({})'.format(content.config.get('title', content.name), context.content_reference_to_url(groups[1]))
-    body = re.sub(r'(\[\[)([^\]]+?)(\]\])', callback, body)
+class _HighlightExtension(object):
+  """
+  Takes the place of the `pygments` extension of #nr.markdown and highlights
+  code blocks with #MarkdownJinjaContentRenderer.highlight_code(). Implements the
+  interface of #nr.markdown.Extension without importing the module.
+  """
 
-    # Render the body with Jinja2.
-    env = jinja2.Environment()
-    template = env.from_string(body)
-    body = template.render(context.template_vars)
+  def __init__(self, renderer, context):
+    self.renderer = renderer
+    self.context = context
 
-    md = nr.markdown.Markdown()
-    content._mdcache = md(body)
-    content._mdtoc = md.toc
-    return content._mdcache
+  def run(self, method, kwargs):
+    if method == 'blockcode':
+      return self.blockcode(kwargs)
+
+  def blockcode(self, kwargs):
+    if not kwargs['lang']:
+      return None
+    options = kwargs['md'].options.get('pygments_html_formatter_options')
+    if options is None:
+      options = {'noclasses': True}
+    return self.renderer.highlight_code(self.context, kwargs['text'], kwargs['lang'], options)
 
 
 class JinjaTemplateRenderer(TemplateRenderer):
+  """
+  Renders Jinja templates from the project's `templates/` directory and the
+  site template's template directory. The #jinja2.Environment is created once
+  per #Context and reused for all renders, including rebuilds in watch mode,
+  so templates are only parsed and compiled again when they change on disk.
+
+  If the `statigen.templateCache` option is enabled, the compiled bytecode is
+  additionally cached in the `jinja/` subdirectory of the
+  #Context.get_cache_directory(). Jinja invalidates these entries when the
+  checksum of the template source changes.
+  """
+
+  def __init__(self):
+    self._environments = weakref.WeakKeyDictionary()
+    self._dependencies = weakref.WeakKeyDictionary()
+    self._lock = threading.Lock()
+
+  def get_environment(self, context):
+    with self._lock:
+      return self._get_environment(context)
+
+  def _get_environment(self, context):
+    env = self._environments.get(context)
+    if env is None:
+      import jinja2
+      paths = []
+      paths.append(path.join(context.project_directory, 'templates'))
+      paths.append(context.get_template_directory())
+      bytecode_cache = None
+      if context.config.get('statigen.templateCache', False):
+        directory = path.join(context.get_cache_directory(), 'jinja')
+        path.makedirs(directory)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+      loader = jinja2.FileSystemLoader(paths)
+      env = jinja2.Environment(loader=loader, auto_reload=True,
+        bytecode_cache=bytecode_cache)
+      self._environments[context] = env
+    return env
 
   def render_template(self, context, template, vars):
-    paths = []
-    paths.append(path.join(context.project_directory, 'templates'))
-    paths.append(context.get_template_directory())
-    loader = jinja2.FileSystemLoader(paths)
-    env = jinja2.Environment(loader=loader)
-    template = env.get_template(template)
+    template = self.get_environment(context).get_template(template)
     context.template_vars = vars
     return template.render(vars)
 
+  def get_template_dependencies(self, context, template):
+    from jinja2.meta import find_referenced_templates
+
+    def mtime(filename):
+      try:
+        return os.stat(filename).st_mtime_ns
+      except OSError:
+        return None
+
+    # The result is cached until one of the files changes.
+    cache = self._dependencies.setdefault(context, {})
+    if template in cache:
+      filenames, mtimes = cache[template]
+      if filenames is not None and [mtime(x) for x in filenames] == mtimes:
+        return filenames
+
+    env = self.get_environment(context)
+    filenames = []
+    pending = [template]
+    seen = set()
+    while pending:
+      name = pending.pop()
+      if name in seen:
+        continue
+      seen.add(name)
+      source, filename, _ = env.loader.get_source(env, name)
+      filename = path.canonical(filename)
+      # Templates with the same name in a directory that comes earlier in
+      # the search path would take precedence if they were created.
+      for directory in env.loader.searchpath:
+        candidate = path.canonical(path.join(directory, name))
+        if candidate == filename:
+          break
+        filenames.append(candidate)
+      filenames.append(filename)
+      for ref in find_referenced_templates(env.parse(source)):
+        if ref is None:
+          # Dynamic template name, we can't know what is being included.
+          cache[template] = (None, None)
+          return None
+        pending.append(ref)
+
+    cache[template] = (filenames, [mtime(x) for x in filenames])
+    return filenames
+
 
 class PythonSiteTemplate(SiteTemplate):
 
@@ -263,12 +826,19 @@ class PythonSiteTemplate(SiteTemplate):
   def render(self, context):
     return self.module.render(context)
 
+  def get_render_executor(self, context):
+    return getattr(self.module, 'render_executor', 'process')
+
   @classmethod
-  def load(cls, name, parent_dir=None):
+  def load(cls, name, parent_dir=None, cache_dir=None):
     """
     Loads a Python site template from a Python source file. Ensures that the
     loaded module has a `render()` function. The template will be searched for
     in the statigen templates directory or relative to the *parent_dir*.
+
+    If *cache_dir* is specified, the compiled code of the template is cached
+    in its `site-templates/` subdirectory and only compiled again when the
+    hash of the source file changes.
     """
 
     parent_dir = parent_dir or os.getcwd()
@@ -286,19 +856,137 @@ class PythonSiteTemplate(SiteTemplate):
       # TODO: Proper exception type
       raise ValueError('Template not found: {!r}'.format(name))
 
-    with open(filename) as fp:
-      code = fp.read()
+    with open(filename, 'rb') as fp:
+      source = fp.read()
+    if cache_dir:
+      code = cls._compile_cached(source, filename, cache_dir)
+    else:
+      code = compile(source, filename, 'exec')
 
     module = types.ModuleType(path.base(name))
     module.__file__ = filename
 
-    six.exec_(compile(code, filename, 'exec'), vars(module))
+    six.exec_(code, vars(module))
     if not callable(getattr(module, 'render', None)):
       # TODO: Proper exception type
       raise ValueError('Template {!r} has no render() function or render is not callable'.format(name))
 
     return cls(module)
 
+  @staticmethod
+  def _compile_cached(source, filename, cache_dir):
+    import marshal
+    key = hashlib.sha1((sys.version + '\0' + filename).encode('utf8')).hexdigest()
+    cache_file = path.join(cache_dir, 'site-templates', key)
+    digest = hashlib.sha1(source).hexdigest().encode('ascii')
+    try:
+      with open(cache_file, 'rb') as fp:
+        if fp.read(len(digest)) == digest:
+          return marshal.load(fp)
+    except (OSError, EOFError, ValueError, TypeError):
+      pass
+
+    code = compile(source, filename, 'exec')
+    try:
+      path.makedirs(path.dir(cache_file))
+      fd, tmp = tempfile.mkstemp(dir=path.dir(cache_file), suffix='.tmp')
+    except OSError:
+      return code
+    try:
+      with os.fdopen(fd, 'wb') as fp:
+        fp.write(digest)
+        marshal.dump(code, fp)
+      os.replace(tmp, cache_file)
+    except OSError:
+      os.remove(tmp)
+    return code
+
+
+class MinifyPostProcessor(PostProcessor):
+  """
+  Removes insignificant whitespace and comments from HTML and CSS files. In
+  HTML, runs of whitespace between tags are collapsed and the contents of
+  tags, `<pre>`, `<textarea>`, `<script>` and `<style>` elements are left
+  untouched. Conditional comments are kept.
+  """
+
+  _html_tokens = re.compile(
+    br'(<(pre|textarea|script|style)\b.*?</\2\s*>)|(<!--(?!\[if).*?-->)'
+    br'|(<(?:[^>"\']|"[^"]*"|\'[^\']*\')*>)|(\s+)', re.S | re.I)
+  _css_tokens = re.compile(
+    br'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')|(/\*(?!!).*?\*/)'
+    br'|(;(?:\s|/\*(?!!).*?\*/)*})|(\s+)', re.S)
+  _css_separators = frozenset(b'{};,')
+
+  def process(self, context, filename, data):
+    suffix = path.getsuffix(filename).lower()
+    if suffix in ('html', 'htm'):
+      return self.minify_html(data)
+    elif suffix == 'css':
+      return self.minify_css(data)
+    return data
+
+  def minify_html(self, data):
+    def replace(match):
+      if match.group(3) is not None:
+        return b''
+      elif match.group(5) is None:
+        return match.group(0)
+      return b'\n' if b'\n' in match.group(5) else b' '
+    return self._html_tokens.sub(replace, data).strip()
+
+  def minify_css(self, data):
+    separators = self._css_separators
+    def replace(match):
+      if match.group(1) is not None:
+        return match.group(1)
+      elif match.group(2) is not None:
+        return b''
+      elif match.group(3) is not None:
+        # The last semicolon of a block.
+        return b'}'
+      before = data[match.start() - 1] if match.start() > 0 else None
+      after = data[match.end()] if match.end() < len(data) else None
+      if before is None or after is None or before in separators \
+          or after in separators or before == ord(':'):
+        return b''
+      return b' '
+    return self._css_tokens.sub(replace, data).strip()
+
+
+class CompressPostProcessor(PostProcessor):
+  """
+  Writes a `.gz` file next to every compressible file, and a `.br` file if
+  the `brotli` module is installed, for web servers that serve precompressed
+  files (eg. nginx with `gzip_static`). The compressed files are reproducible
+  and only produced again if the file changed.
+  """
+
+  SUFFIXES = frozenset(['html', 'htm', 'css', 'js', 'json', 'svg', 'xml', 'txt', 'map'])
+
+  def __init__(self):
+    try:
+      import brotli
+    except ImportError:
+      brotli = None
+    self._brotli = brotli
+
+  def get_derived_files(self, context, filename):
+    if path.getsuffix(filename).lower() not in self.SUFFIXES:
+      return []
+    files = [(filename + '.gz', self.gzip)]
+    if self._brotli is not None:
+      files.append((filename + '.br', self.brotli))
+    return files
+
+  @staticmethod
+  def gzip(data):
+    import gzip
+    return gzip.compress(data, 9, mtime=0)
+
+  def brotli(self, data):
+    return self._brotli.compress(data)
+
 
 ##
 # Static site generation logic and configuration
@@ -353,11 +1041,14 @@ class Config(object):
 
   def __init__(self, data):
     self._data = data
+    self._access_hook = None
 
   def __repr__(self):
     return 'Config({!r})'.format(self._data)
 
   def option(self, key, create_intermediate=False):
+    if self._access_hook is not None:
+      self._access_hook(key)
     container = self._data
     parts = key.split('.')
     for part in parts[:-1]:
@@ -397,14 +1088,15 @@ class Config(object):
     return self.option(key).pop(default)
 
 
-class Content(object):
+class _ContentBase(object):
   """
-  A Content object represents a content source file that can be rendered and
-  embedded into the body of a template. It may contain properties that can be
-  taken into account by the template.
+  Implements the behaviour that is shared by #Content and its compact
+  variant that is used in #Context.low_memory builds.
   """
 
-  def __init__(self, context, filename, assets, name, config, body):
+  __slots__ = ()
+
+  def __init__(self, context, filename, assets, name, config, body, sources=None):
     if not isinstance(config, Config):
       config = Config(config)
     self.context = context
@@ -413,197 +1105,2924 @@ class Content(object):
     self.name = name
     self.config = config
     self.body = body
+    self.sources = [path.canonical(x) for x in (sources or [filename])]
 
   def __repr__(self):
     return 'Content(name={!r}, filename={!r})'.format(self.name, self.filename)
 
+  @property
+  def body(self):
+    if self._body is None:
+      self._body = self._load_body()
+    return self._body
+
+  @body.setter
+  def body(self, body):
+    if callable(body):
+      self._load_body, self._body = body, None
+    else:
+      self._load_body, self._body = None, body
+
+  def release(self):
+    """
+    Releases the #body, if it can be loaded again, and the data that the
+    content renderer keeps for this content. Used by #Context.low_memory
+    builds after the pages that use the content were written.
+    """
+
+    if self._load_body is not None:
+      self._body = None
+    self.context.content_renderer.release_content(self.context, self)
+
   def toc(self):
+    self.context.record_dependencies(self.sources)
     return self.context.content_renderer.get_table_of_contents(self.context, self)
 
   def render(self):
+    self.context.record_dependencies(self.sources, self)
     return self.context.content_renderer.render_content(self.context, self)
 
 
-class Context(object):
-  """
-  The context contains all information required for the rendering process.
+class Content(six.with_metaclass(abc.ABCMeta, _ContentBase)):
   """
+  A Content object represents a content source file that can be rendered and
+  embedded into the body of a template. It may contain properties that can be
+  taken into account by the template.
 
-  def __init__(self, config, site_template, content_loader=None,
-               content_renderer=None, template_renderer=None):
-    if not isinstance(config, Config):
-      config = Config(config)
-    self.config = config
-    self.project_directory = '.'
-    self.site_template = site_template
-    self.content_loader = content_loader or MarkdownTomlContentLoader()
-    self.content_renderer = content_renderer or MarkdownJinjaContentRenderer()
-    self.template_renderer = template_renderer or JinjaTemplateRenderer()
-    self.globals = {}
-    self.current_url = None
+  The *body* may be a callable that returns the body, in which case it is
+  only loaded when the #body is accessed for the first time.
 
-    self.config.setdefault('statigen.urlFormat', 'file')
-    self.config.setdefault('statigen.contentDirectory', '.')
-    self.config.setdefault('statigen.buildDirectory', 'build')
-    self.config.setdefault('statigen.contentEncoding', 'utf8')
-    self.config.setdefault('statigen.siteEncoding', 'utf8')
+  In #Context.low_memory builds, content is loaded as a compact object that
+  uses `__slots__` and has no `__dict__`. Other attributes, like the
+  `children` and `url` that site templates assign to pages, are stored in its
+  `attrs` dictionary instead. It is still an instance of #Content.
+  """
 
-    self.content_encoding = self.config['statigen.contentEncoding']
-    self.site_encoding = self.config['statigen.siteEncoding']
+  def _attributes(self):
+    return vars(self)
 
-    self.site_template.init(self)
 
-  def real_url(self, url, isfile=True):
-    """
-    Takes a basic URL and converts it to the real URL.
-    """
+class _CompactContent(_ContentBase):
+  """
+  The #Content that is loaded in #Context.low_memory builds. Attributes that
+  are not slots are stored in the #attrs dictionary, which is only created
+  when the first such attribute is assigned.
+  """
 
-    if not url.startswith('/'):
-      raise ValueError('URL must start with a slash')
-    is_dir_format = (self.config['statigen.urlFormat'] == 'directory')
-    if url == '/':
-      return '/' if is_dir_format else '/index.html'
-    url = posixpath.normpath(url).rstrip('/')
-    if is_dir_format or not isfile:
-      return url
+  __slots__ = ('context', 'filename', 'assets', 'name', 'config', 'sources',
+               'attrs', '_body', '_load_body', '_mdcache', '_mdtoc')
+
+  def __init__(self, *args, **kwargs):
+    self.attrs = None
+    _ContentBase.__init__(self, *args, **kwargs)
+
+  def __getattr__(self, name):
+    # Only called if *name* is not a slot or the slot is not set.
+    if name not in _CompactContent.__slots__:
+      attrs = self.attrs
+      if attrs is not None and name in attrs:
+        return attrs[name]
+    raise AttributeError('{!r} object has no attribute {!r}'.format(
+      type(self).__name__, name))
+
+  def __setattr__(self, name, value):
+    if hasattr(type(self), name):
+      object.__setattr__(self, name, value)
     else:
-      return url + '.html'
+      if self.attrs is None:
+        self.attrs = {}
+      self.attrs[name] = value
 
-  def url_to_filename(self, url, isfile=True):
-    """
-    Takes a basic URL and converts it to the actualy filename relative to
-    the build directory.
-    """
+  def __delattr__(self, name):
+    if hasattr(type(self), name):
+      object.__delattr__(self, name)
+    else:
+      try:
+        del self.attrs[name]
+      except (TypeError, KeyError):
+        raise AttributeError(name)
 
-    url = self.real_url(url, isfile)
-    if url == '/':
-      return 'index.html' if isfile else '/'
+  def _attributes(self):
+    attrs = {k: getattr(self, k) for k in _CompactContent.__slots__
+             if not k.startswith('_') and k != 'attrs'}
+    attrs.update(self.attrs or {})
+    return attrs
 
-    url = url.lstrip('/')
-    if isfile and self.config['statigen.urlFormat'] == 'directory':
-      return url + '/index.html'
-    return url
 
-  def url_to_abs_filename(self, url, isfile=True):
-    build_dir = self.config['statigen.buildDirectory']
-    return path.canonical(self.url_to_filename(url, isfile), build_dir)
+Content.register(_CompactContent)
 
-  def url_to(self, target, source=None, isfile=True):
-    if source is None:
-      if self.current_url is None:
-        raise RuntimeError('Context.current_url is not set.')
-      source = self.current_url
 
-    source = self.real_url(source, isfile)
-    target = self.real_url(target, isfile)
-    res = posixpath.relpath(target, posixpath.dirname(source))
-    if self.config['statigen.urlFormat'] == 'directory' and source != '/':
-      res = '../' + res
-    return res
+class ContentRegistry(object):
+  """
+  Keeps track of the #Content objects loaded by a #Context, keyed by the
+  canonical filename that they were loaded from (the first of their
+  #Content.sources). Content loaders look up content in the registry before
+  they load a file. An entry is only returned as long as none of its source
+  files was modified, which keeps the registry valid between builds in watch
+  mode. The #hits and #misses counters count the lookups.
+  """
 
-  def content_reference_to_url(self, ref, source=None, isfile=None):
-    """
-    Transforms a content reference to a relative URL from *source* or the
-    Context's current URL. If *isfile* is #None (default), the type of the
-    reference will be determined automatically (content or asset).
-    """
+  def __init__(self):
+    self.hits = 0
+    self.misses = 0
+    self._entries = {}
 
-    if not source:
-      if not self.current_url:
-        raise RuntimeError('no current URL')
-      source = self.current_url
+  def __contains__(self, content):
+    entry = self._entries.get(content.sources[0])
+    return entry is not None and entry[0] is content
 
-    if isfile is None:
-      isfile = not path.getsuffix(ref)
+  def __iter__(self):
+    return iter([x[0] for x in list(self._entries.values())])
 
-    ref, fragment = ref.partition('#')[::2]
-    url = posixpath.join(source, ref)
-    result = self.url_to(url, source, isfile)
-    if fragment:
-      result += '#' + fragment
-    return result
+  def __len__(self):
+    return len(self._entries)
 
-  def render(self, __url, __template, **vars):
+  @staticmethod
+  def _mtimes(filenames):
+    try:
+      return [os.stat(x).st_mtime_ns for x in filenames]
+    except OSError:
+      return None
+
+  def get(self, filename):
     """
-    Renders a template for a URL into the build directory.
+    Returns the #Content loaded from *filename* or #None if it has not been
+    loaded or one of its source files changed since then.
     """
 
-    self.current_url = __url
-    try:
-      filename = self.url_to_abs_filename(__url)
-      print('rendering {} ({})'.format(filename, __url))
-
-      vars.setdefault('context', self)
-      vars.setdefault('config', self.config)
-      vars.setdefault('url_to', self.url_to)
-      vars.setdefault('url_for', lambda x: self.url_to(x, isfile=False))
-      vars = ChainMap(vars, self.globals)
-
-      path.makedirs(path.dir(filename))
-      with io.open(filename, 'w', encoding=self.site_encoding) as fp:
-        fp.write(self.template_renderer.render_template(self, __template, vars))
-    finally:
-      self.current_url = None
+    entry = self._entries.get(filename)
+    if entry is not None:
+      content, mtimes = entry[:2]
+      if mtimes is not None and self._mtimes(content.sources) == mtimes:
+        self.hits += 1
+        return content
+      self._entries.pop(filename, None)
+    self.misses += 1
+    return None
+
+  def add(self, content):
+    entry = self._entries.get(content.sources[0])
+    if entry is not None and entry[0] is content:
+      config = entry[2]
+    else:
+      config = fingerprint(content.config)
+    self._entries[content.sources[0]] = (content, self._mtimes(content.sources), config)
 
-  def copy(self, url, source):
+  def lookup(self, filename):
     """
-    Copy the file or directory *source* from the site templates main directory
-    so that it is available from the specified URL.
+    Returns the #Content loaded from *filename* or #None, regardless of
+    whether the file changed.
     """
 
-    if path.isabs(source):
-      choices = [source]
-    else:
-      parent_dirs = [self.site_template.get_main_directory(self)]
-      parent_dirs += [self.project_directory]
-      choices = [path.join(x, source) for x in parent_dirs]
+    entry = self._entries.get(filename)
+    return entry[0] if entry is not None else None
 
-    target = self.url_to_abs_filename(url, False)
-    print('copying {} ==> {} ({})'.format(source, target, url))
+  def find(self, filename):
+    """
+    Returns a list of the registered #Content objects that have *filename* in
+    their #Content.sources, regardless of whether the file changed.
+    """
 
-    for current in choices:
-      if path.exists(current):
-        print('  from {}'.format(current))
-        copy_tree(current, target)
+    return [x[0] for x in list(self._entries.values()) if filename in x[0].sources]
 
-  def copy_assets(self, url, content):
+  def get_config_fingerprint(self, content):
     """
-    Copy the assets associated with the specified #Content object to the
-    static output directory for *url*. The URL should be the same that the
-    #Content was rendered with.
+    Returns the #fingerprint() of the configuration of *content* at the time
+    it was first added to the registry.
     """
 
-    if path.exists(content.assets):
-      self.copy(url, path.abs(content.assets))
+    return self._entries[content.sources[0]][2]
 
-  def load_content_from_directory(self, directory):
-    if not path.isabs(directory):
-      content_directory = self.config['statigen.contentDirectory']
-      directory = path.join(content_directory, directory)
-    result = []
-    for content in self.content_loader.load_content_from_directory(self, directory):
-      self.site_template.content_loaded(self, content)
-      result.append(content)
-    return result
+  def clear(self):
+    self._entries.clear()
+
+
+class ContentIndex(object):
+  """
+  An index of the files with the specified *suffix* in the *root* directory
+  and its subdirectories, created with a single walk using #os.scandir().
+  Directories whose name starts with a dot, the directories in *exclude*,
+  symbolic links to directories, directories that can not be read and
+  directories of other tools (#SKIP_NAMES and virtual environments) are not
+  indexed. Such directories and directories outside of the *root* are listed
+  when they are requested.
+
+  Data for every indexed file can be computed in parallel with #prefetch()
+  and retrieved once with #pop_data().
+  """
+
+  SKIP_NAMES = frozenset(['node_modules', '__pycache__'])
+
+  def __init__(self, root, suffix, exclude=()):
+    self.root = path.canonical(root)
+    self.suffix = suffix
+    self.directories = {}
+    self._skipped = []
+    self._data = {}
+    self._futures = {}
+    self._futures_pid = None
+    self._lock = threading.Lock()
+    exclude = set(path.canonical(x) for x in exclude)
+
+    stack = [self.root]
+    while stack:
+      directory = stack.pop()
+      names, subdirs = [], []
+      try:
+        with os.scandir(directory) as it:
+          for entry in it:
+            # Symbolic links are not followed, which could leave the root or
+            # loop forever.
+            if entry.is_dir(follow_symlinks=False):
+              subdirs.append(path.join(directory, entry.name))
+            elif entry.is_symlink() and entry.is_dir():
+              self._skipped.append(path.join(directory, entry.name))
+            elif entry.name.endswith(suffix):
+              names.append(entry.name)
+      except OSError:
+        self._skipped.append(directory)
+        continue
+      for subdir in subdirs:
+        if self._skip(subdir, exclude):
+          self._skipped.append(subdir)
+        else:
+          stack.append(subdir)
+      self.directories[directory] = sorted(names)
+
+  def _skip(self, directory, exclude):
+    name = path.base(directory)
+    return name.startswith('.') or name in self.SKIP_NAMES or \
+      directory in exclude or path.isfile(path.join(directory, 'pyvenv.cfg'))
+
+  def _is_indexed(self, directory):
+    if directory != self.root and not path.issub(path.rel(directory, self.root)):
+      return False
+    for skipped in self._skipped:
+      if directory == skipped or path.issub(path.rel(directory, skipped)):
+        return False
+    return True
+
+  def listdir(self, directory):
+    """
+    Returns the names of the files with the index suffix in *directory*.
+    Raises a #FileNotFoundError if the directory does not exist.
+    """
+
+    directory = path.canonical(directory)
+    names = self.directories.get(directory)
+    if names is None:
+      if self._is_indexed(directory):
+        raise FileNotFoundError(directory)
+      names = sorted(x for x in os.listdir(directory) if x.endswith(self.suffix))
+      with self._lock:
+        self.directories[directory] = names
+    return names
+
+  def isdir(self, directory):
+    directory = path.canonical(directory)
+    if directory in self.directories:
+      return True
+    if self._is_indexed(directory):
+      return False
+    return path.isdir(directory)
+
+  def files(self):
+    for directory, names in self.directories.items():
+      for name in names:
+        yield path.join(directory, name)
+
+  def prefetch(self, func, pipeline=None):
+    """
+    Calls *func* for every indexed file in a thread pool and stores the
+    results. Files for which *func* raises an exception are skipped, so the
+    error is raised when the file is actually loaded.
+
+    If an #IOPipeline is specified, the calls are submitted to it and this
+    method returns immediately. #pop_data() then waits for the result.
+    """
+
+    if pipeline is not None:
+      self._futures.update((x, pipeline.submit(func, x)) for x in self.files())
+      self._futures_pid = os.getpid()
+      return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    def call(filename):
+      try:
+        return filename, func(filename)
+      except Exception:
+        return filename, None
+
+    with ThreadPoolExecutor() as pool:
+      for filename, data in pool.map(call, list(self.files())):
+        if data is not None:
+          self._data[filename] = data
+
+  def pop_data(self, filename):
+    """
+    Returns the data computed by #prefetch() for *filename* and removes it
+    from the index, or returns #None.
+    """
+
+    with self._lock:
+      future = self._futures.pop(filename, None)
+      data = self._data.pop(filename, None)
+    # The pipeline does not run in forked worker processes.
+    if future is not None and (future.done() or os.getpid() == self._futures_pid):
+      try:
+        data = future.result()
+      except Exception:
+        data = None
+    return data
+
+
+class DiskCache(object):
+  """
+  A cache for pickled values in a directory, addressed by string keys (eg. a
+  #fingerprint()). Reading an entry marks it as recently used. The total size
+  of the cache is limited to *max_size* bytes by evicting the least recently
+  used entries in #trim(). If *max_size* is #None, the size is not limited.
+  """
+
+  def __init__(self, directory, max_size):
+    self.directory = directory
+    self.max_size = max_size
+
+  def _filename(self, key):
+    return path.join(self.directory, key[:2], key + '.pickle')
+
+  def get(self, key, default=None):
+    import pickle
+    filename = self._filename(key)
+    try:
+      with open(filename, 'rb') as fp:
+        value = pickle.load(fp)
+      os.utime(filename)
+    except (OSError, EOFError, pickle.UnpicklingError):
+      return default
+    return value
+
+  def set(self, key, value):
+    import pickle
+    filename = self._filename(key)
+    path.makedirs(path.dir(filename))
+    fd, tmp = tempfile.mkstemp(dir=path.dir(filename), suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as fp:
+        pickle.dump(value, fp, pickle.HIGHEST_PROTOCOL)
+      os.replace(tmp, filename)
+    except BaseException:
+      os.remove(tmp)
+      raise
+
+  def trim(self):
+    """
+    Removes the least recently used entries until the size of the cache is
+    no more than #max_size. Returns the number of removed entries.
+    """
+
+    if self.max_size is None:
+      return 0
+    entries = []
+    total_size = 0
+    for root, _, files in os.walk(self.directory):
+      for name in files:
+        filename = os.path.join(root, name)
+        try:
+          st = os.stat(filename)
+        except OSError:
+          continue
+        entries.append((st.st_mtime, st.st_size, filename))
+        total_size += st.st_size
+
+    removed = 0
+    entries.sort()
+    for _, size, filename in entries:
+      if total_size <= self.max_size:
+        break
+      try:
+        os.remove(filename)
+      except OSError:
+        continue
+      total_size -= size
+      removed += 1
+    return removed
+
+  def clear(self):
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class BuildManifest(object):
+  """
+  Records the inputs that were used to render every page with
+  #Context.render(): the files that were read (content files, their
+  `contentFrom` targets, referenced content and templates), the content
+  directories that were listed, the site configuration values that were
+  read, the fingerprinted URLs of the assets that were referenced and a
+  #fingerprint() of the template variables. The manifest is
+  stored as JSON in the #Context.get_cache_directory() and used by
+  incremental builds to decide whether a page needs to be rendered again.
+  The content references resolved by a page are recorded as well, so that
+  they are checked for broken references when the page is skipped.
+  """
+
+  VERSION = 3
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.pages = {}
+    self._visited = set()
+    self._stats = {}
+    self._hashes = {}
+    if path.isfile(filename):
+      with io.open(filename, encoding='utf8') as fp:
+        data = json.load(fp)
+      if data.get('version') == self.VERSION:
+        self.pages = data['pages']
+
+  def begin(self):
+    """
+    Must be called at the beginning of every build and #Context.rebuild().
+    Resets the file signatures that are cached for the duration of a build.
+    """
+
+    self._visited = set()
+    self._stats = {}
+    self._hashes = {}
+
+  def save(self, prune=True):
+    """
+    Saves the manifest. If *prune* is #True, pages that have not been
+    rendered or skipped since the last call to #begin() are dropped from the
+    manifest.
+    """
+
+    if prune:
+      self.pages = {k: v for k, v in self.pages.items() if k in self._visited}
+    path.makedirs(path.dir(self.filename))
+    with io.open(self.filename, 'w', encoding='utf8') as fp:
+      json.dump({'version': self.VERSION, 'pages': self.pages}, fp)
+
+  def _stat(self, filename):
+    if filename not in self._stats:
+      try:
+        st = os.stat(filename)
+      except OSError:
+        self._stats[filename] = None
+      else:
+        self._stats[filename] = [st.st_mtime_ns, st.st_size]
+    return self._stats[filename]
+
+  def _hash(self, filename):
+    if filename not in self._hashes:
+      hasher = hashlib.sha1()
+      with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(65536), b''):
+          hasher.update(chunk)
+      self._hashes[filename] = hasher.hexdigest()
+    return self._hashes[filename]
+
+  def _listing(self, directory):
+    try:
+      return fingerprint(sorted(os.listdir(directory)))
+    except OSError:
+      return None
+
+  def _config_value(self, config, key):
+    return fingerprint(key in config, config.get(key))
+
+  def check(self, context, url, template, vars_fingerprint):
+    """
+    Checks whether the page for *url* needs to be rendered again. Returns a
+    string that describes the reason or #None if the page is up to date.
+    """
+
+    entry = self.pages.get(url)
+    if entry is None:
+      return 'new page'
+    if entry['template'] != template:
+      return 'template changed'
+    if entry['vars'] != vars_fingerprint:
+      return 'variables changed'
+    if entry['files'] is None:
+      return 'unknown template dependencies'
+    if not path.isfile(entry['output']):
+      return 'output missing'
+    for filename, signature in entry['files'].items():
+      stat = self._stat(filename)
+      if signature is None:
+        if stat is not None:
+          return '{} created'.format(filename)
+      elif stat is None:
+        return '{} removed'.format(filename)
+      elif stat != signature[:2] and self._hash(filename) != signature[2]:
+        return '{} changed'.format(filename)
+    for directory, listing in entry['directories'].items():
+      if self._listing(directory) != listing:
+        return '{} changed'.format(directory)
+    for key, value in entry['config'].items():
+      if self._config_value(context.config, key) != value:
+        return 'config {!r} changed'.format(key)
+    for url, fingerprinted_url in entry['assets'].items():
+      if context.routes.get_asset_url(url) != fingerprinted_url:
+        return '{} changed'.format(url)
+    return None
+
+  def visit(self, url, entry=None):
+    """
+    Marks *url* as being part of the current build and replaces its entry
+    with *entry* if specified.
+    """
+
+    self._visited.add(url)
+    if entry is not None:
+      self.pages[url] = entry
+
+  def create_entry(self, context, template, vars_fingerprint, output,
+                   files, directories, config_keys, assets, references):
+    """
+    Creates an entry for a page after it was rendered. If *files* is #None,
+    the dependencies of the page are unknown and it will always be rendered.
+    """
+
+    if files is not None:
+      files = {x: self._stat(x) and self._stat(x) + [self._hash(x)] for x in sorted(files)}
+    return {
+      'template': template,
+      'vars': vars_fingerprint,
+      'output': output,
+      'files': files,
+      'directories': {x: self._listing(x) for x in sorted(directories)},
+      'config': {x: self._config_value(context.config, x) for x in sorted(config_keys)},
+      'assets': assets,
+      'references': [list(x) for x in references],
+    }
+
+
+class FileSync(object):
+  """
+  Copies files into the build directory and skips files that did not change
+  since they were last copied. For every target file, the size and
+  modification time (and with *compare* set to `'hash'`, the SHA1) of its
+  source are recorded in a JSON file, which allows post-processing of the
+  target files without causing them to be copied again.
+
+  The *method* can be `'copy'` (default), `'hardlink'` to create hard links
+  to the source files or `'reflink'` to use #os.copy_file_range(), which
+  shares the data blocks on file systems that support it. Both fall back to
+  a normal copy if they are not supported for a file.
+
+  Target files that have been copied before but are not part of any sync
+  between #begin() and #prune() are removed by the latter. This includes the
+  files that were derived from a target file when it was post-processed.
+  """
+
+  METHODS = ('copy', 'hardlink', 'reflink')
+  COMPARE = ('mtime', 'hash')
+
+  def __init__(self, filename, method='copy', compare='mtime', jobs=1):
+    if method not in self.METHODS:
+      raise ValueError('invalid copy method: {!r}'.format(method))
+    if compare not in self.COMPARE:
+      raise ValueError('invalid copy comparison: {!r}'.format(compare))
+    self.filename = filename
+    self.method = method
+    self.compare = compare
+    self.jobs = jobs
+    self.files = {}
+    self.hashes = {}
+    self._visited = set()
+    self._hashed = set()
+    if path.isfile(filename):
+      with io.open(filename, encoding='utf8') as fp:
+        data = json.load(fp)
+      if isinstance(data.get('files'), dict):
+        self.files, self.hashes = data['files'], data['hashes']
+      else:
+        self.files = data
+
+  def begin(self):
+    self._visited = set()
+    self._hashed = set()
+
+  def save(self):
+    self.hashes = {k: v for k, v in self.hashes.items() if k in self._hashed}
+    path.makedirs(path.dir(self.filename))
+    with io.open(self.filename, 'w', encoding='utf8') as fp:
+      json.dump({'files': self.files, 'hashes': self.hashes}, fp)
+
+  def get_hash(self, source):
+    """
+    Returns the SHA1 of the file *source*. The hash is only computed again
+    if the size or modification time of the file changed since the last
+    call.
+    """
+
+    st = os.stat(source)
+    signature = [st.st_mtime_ns, st.st_size]
+    previous = self.hashes.get(source)
+    if previous is not None and previous[:2] == signature:
+      sha1 = previous[2]
+    else:
+      sha1 = self._hash(source)
+      self.hashes[source] = signature + [sha1]
+    self._hashed.add(source)
+    return sha1
+
+  def prune(self):
+    """
+    Removes target files that were copied previously, but not since the last
+    call to #begin(). Returns the list of removed files.
+    """
+
+    removed = []
+    for filename in sorted(set(self.files) - self._visited):
+      del self.files[filename]
+      if path.isfile(filename):
+        os.remove(filename)
+        removed.append(filename)
+    return removed
+
+  @staticmethod
+  def _hash(filename):
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+      for chunk in iter(lambda: fp.read(65536), b''):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+  def _is_unchanged(self, source, target, st, key):
+    signature = [st.st_mtime_ns, st.st_size]
+    previous = self.files.get(target)
+    if previous is None:
+      # Adopt files copied before the target was recorded, for example by
+      # an older version of statigen, which preserved the modification time.
+      try:
+        tst = os.stat(target)
+      except OSError:
+        return False
+      if [tst.st_mtime_ns, tst.st_size] != signature:
+        return False
+      previous = signature + [None]
+    elif not path.isfile(target):
+      return False
+    if (previous[3] if len(previous) > 3 else None) != key:
+      return False
+    if previous[:2] == signature:
+      if self.compare == 'hash' and previous[2] is None:
+        self.files[target] = signature + [self._hash(source)] + previous[3:]
+      return True
+    if self.compare == 'hash' and previous[2] == self._hash(source):
+      self.files[target] = signature + previous[2:]
+      return True
+    return False
+
+  def _copy_file(self, source, target):
+    path.makedirs(path.dir(target))
+    if os.path.lexists(target):
+      if os.path.realpath(source) == os.path.realpath(target):
+        return
+      # The target may be a hard link to the source from a previous build
+      # with the `hardlink` method, which must not be written to.
+      os.remove(target)
+    if self.method == 'hardlink':
+      try:
+        os.link(source, target)
+        return
+      except OSError:
+        pass
+    elif self.method == 'reflink' and hasattr(os, 'copy_file_range'):
+      try:
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+          while os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30):
+            pass
+        shutil.copystat(source, target)
+        return
+      except OSError:
+        pass
+    shutil.copy2(source, target)
+
+  def sync(self, files, force=False, map_func=None, process=None, key=None):
+    """
+    Copies the files specified as a list of `(source, target)` tuples. If
+    *force* is #True, all files are copied. Files are copied with *map_func*
+    if it is specified (eg. #IOPipeline.map()). Returns a
+    #collections.Counter with the keys `copied`, `copied_bytes`, `unchanged`
+    and `unchanged_bytes`.
+
+    If *process* is specified, it is called with every copied target file
+    and must return a list of the files that it derived from it. The *key*
+    identifies the processing; files that were processed with a different
+    key are copied again.
+    """
+
+    stats = collections.Counter()
+    pending = []
+    for source, target in files:
+      self._visited.add(target)
+      st = os.stat(source)
+      if not force and self._is_unchanged(source, target, st, key):
+        previous = self.files[target]
+        self._visited.update(previous[4] if len(previous) > 4 else ())
+        stats['unchanged'] += 1
+        stats['unchanged_bytes'] += st.st_size
+      else:
+        pending.append((source, target, st))
+        stats['copied'] += 1
+        stats['copied_bytes'] += st.st_size
+
+    def copy(item):
+      source, target, st = item
+      self._copy_file(source, target)
+      sha1 = self._hash(source) if self.compare == 'hash' else None
+      record = [st.st_mtime_ns, st.st_size, sha1]
+      if process is not None:
+        derived = process(target)
+        for filename in derived:
+          self.files[filename] = None
+          self._visited.add(filename)
+        record += [key, derived]
+      self.files[target] = record
+
+    if map_func is not None:
+      map_func(copy, pending)
+    elif self.jobs > 1 and len(pending) > 1:
+      from concurrent.futures import ThreadPoolExecutor
+      with ThreadPoolExecutor(self.jobs) as pool:
+        list(pool.map(copy, pending))
+    else:
+      for item in pending:
+        copy(item)
+
+    return stats
+
+
+class PageWriter(object):
+  """
+  Writes rendered pages into the build directory. The modification time,
+  size and SHA1 of every written file are recorded in a JSON file. If a page
+  has the same content as the existing file, the file is not written again,
+  so that its modification time is preserved for tools that synchronize the
+  build directory. Otherwise the content is written to a temporary file that
+  is then moved into place, so a partially written page is never visible.
+
+  Records of files that were not written or skipped since #begin() are
+  dropped when the writer is saved.
+
+  Files that are derived from a page (see #PostProcessor.get_derived_files())
+  are written with the SHA1 of the page as their *source*, which allows to
+  check whether they are up to date with #is_derived_from(). Unlike pages,
+  derived files that were not written or skipped are removed when the writer
+  is saved, so that they can not get out of sync with their page.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.files = {}
+    self._visited = set()
+    self._mode = get_default_file_mode()
+    if path.isfile(filename):
+      with io.open(filename, encoding='utf8') as fp:
+        self.files = json.load(fp)
+
+  def begin(self):
+    self._visited = set()
+
+  def save(self, prune=True):
+    """
+    Saves the records. If *prune* is #True, the records of files that were
+    not written or skipped since #begin() are dropped. Returns the list of
+    derived files that were removed.
+    """
+
+    removed = []
+    if prune:
+      for filename, record in list(self.files.items()):
+        if filename in self._visited:
+          continue
+        del self.files[filename]
+        if len(record) > 3 and path.isfile(filename):
+          os.remove(filename)
+          removed.append(filename)
+    path.makedirs(path.dir(self.filename))
+    with io.open(self.filename, 'w', encoding='utf8') as fp:
+      json.dump(self.files, fp)
+    return removed
+
+  def _digest(self, filename, st):
+    previous = self.files.get(filename)
+    if previous is not None and previous[:2] == [st.st_mtime_ns, st.st_size]:
+      return previous[2]
+    return FileSync._hash(filename)
+
+  def write(self, filename, data, source=None):
+    """
+    Writes the bytes *data* to *filename* unless the file already contains
+    them. Does not modify the writer, as it may be called in a worker
+    process. Returns a tuple of whether the file was written and the record
+    that must be passed to #update().
+    """
+
+    sha1 = hashlib.sha1(data).hexdigest()
+    extra = [] if source is None else [source]
+    try:
+      st = os.stat(filename)
+    except FileNotFoundError:
+      st = None
+    if st is not None and st.st_size == len(data) and self._digest(filename, st) == sha1:
+      return False, [st.st_mtime_ns, st.st_size, sha1] + extra
+
+    write_file_atomic(filename, data, self._mode)
+    st = os.stat(filename)
+    return True, [st.st_mtime_ns, st.st_size, sha1] + extra
+
+  def is_derived_from(self, filename, source):
+    """
+    Returns #True if *filename* was written with the specified *source* and
+    did not change since.
+    """
+
+    record = self.files.get(filename)
+    if record is None or len(record) < 4 or record[3] != source:
+      return False
+    try:
+      st = os.stat(filename)
+    except FileNotFoundError:
+      return False
+    return record[:2] == [st.st_mtime_ns, st.st_size]
+
+  def update(self, filename, record):
+    self.files[filename] = record
+    self._visited.add(filename)
+
+  def visit(self, filename):
+    self._visited.add(filename)
+
+
+class IOPipeline(object):
+  """
+  Performs the file I/O of a #Context.build() in an asyncio event loop that
+  runs in a background thread, so that it overlaps with rendering. Content
+  files are prefetched with #submit(), and rendered pages are passed to
+  #write(). That method puts them into a bounded write-behind queue and only
+  blocks while the queue is full. At most *max_open_files* blocking file
+  operations run at the same time.
+
+  The pipeline can only be used from the process that created it. Pages
+  rendered in forked worker processes are written directly. Before the
+  process forks, #wait() must be called so that the threads of the pipeline
+  are idle. Its threads are named with the #THREAD_NAME prefix.
+  """
+
+  THREAD_NAME = 'statigen-io'
+
+  def __init__(self, writer, max_open_files=64, queue_size=256):
+    self.writer = writer
+    self.max_open_files = max_open_files
+    self.queue_size = queue_size
+    self.pid = os.getpid()
+    self._loop = None
+    self._thread = None
+    self._results = []
+    self._errors = []
+    self._pending = set()
+
+  def start(self):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    self._loop = asyncio.new_event_loop()
+    self._loop.set_default_executor(ThreadPoolExecutor(self.max_open_files,
+      thread_name_prefix=self.THREAD_NAME))
+    self._thread = threading.Thread(target=self._loop.run_forever,
+      name=self.THREAD_NAME, daemon=True)
+    self._thread.start()
+
+    async def setup():
+      self._semaphore = asyncio.Semaphore(self.max_open_files)
+      self._queue = asyncio.Queue(self.queue_size)
+      self._workers = [asyncio.ensure_future(self._write_worker())
+                       for _ in range(self.max_open_files)]
+    self._run(setup())
+
+  def stop(self):
+    """
+    Waits for all pending writes and stops the event loop. Returns the
+    results of the writes, see #drain().
+    """
+
+    try:
+      return self.drain()
+    finally:
+      async def teardown():
+        for worker in self._workers:
+          worker.cancel()
+      self._run(teardown())
+      self._loop.call_soon_threadsafe(self._loop.stop)
+      self._thread.join()
+      self._loop.run_until_complete(self._loop.shutdown_default_executor())
+      self._loop.close()
+
+  def _run(self, coro):
+    import asyncio
+    return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+  async def _call(self, func, *args):
+    async with self._semaphore:
+      return await self._loop.run_in_executor(None, func, *args)
+
+  async def _write_worker(self):
+    while True:
+      filename, data, source = await self._queue.get()
+      try:
+        written, record = await self._call(self.writer.write, filename, data, source)
+        self._results.append((filename, written, record))
+      except Exception as exc:
+        self._errors.append(exc)
+      finally:
+        self._queue.task_done()
+
+  def submit(self, func, *args):
+    """
+    Schedules a call to *func* and returns a #concurrent.futures.Future.
+    """
+
+    import asyncio
+    future = asyncio.run_coroutine_threadsafe(self._call(func, *args), self._loop)
+    self._pending.add(future)
+    future.add_done_callback(self._pending.discard)
+    return future
+
+  def map(self, func, items):
+    """
+    Calls *func* for all *items* concurrently and returns the results.
+    """
+
+    futures = [self.submit(func, x) for x in items]
+    return [x.result() for x in futures]
+
+  def write(self, filename, data, source=None):
+    """
+    Queues the bytes *data* to be written to *filename* by the #PageWriter.
+    Blocks while the queue is full.
+    """
+
+    self._run(self._queue.put((filename, data, source)))
+
+  def drain(self):
+    """
+    Waits until all queued pages are written. Returns a list of
+    `(filename, written, record)` tuples for the pages written since the last
+    call, see #PageWriter.write(). Raises the first error that occurred
+    while writing.
+    """
+
+    self._run(self._queue.join())
+    results, self._results = self._results, []
+    errors, self._errors = self._errors, []
+    if errors:
+      raise errors[0]
+    return results
+
+  def wait(self):
+    """
+    Waits until all submitted calls and queued pages are done, without
+    collecting the results of the writes.
+    """
+
+    import concurrent.futures
+    self._run(self._queue.join())
+    concurrent.futures.wait(list(self._pending))
+
+
+class Profiler(object):
+  """
+  Measures the time spent in the stages of a build, per page. Stages are
+  measured with #Context.profile() and may be nested, in which case the time
+  of the outer stage does not include the time of the inner stage. If
+  *memory* is #True, the peak memory allocated during each stage is traced
+  with #tracemalloc (which slows the build down considerably). Peak memory is
+  only accurate when pages are not rendered in threads.
+  """
+
+  def __init__(self, memory=False):
+    self.memory = memory
+    self.seconds = 0.0
+    self._records = {}
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._started = None
+
+  def start(self):
+    if self.memory:
+      import tracemalloc
+      tracemalloc.start()
+    self._started = time.perf_counter()
+
+  def stop(self):
+    self.seconds += time.perf_counter() - self._started
+    if self.memory:
+      import tracemalloc
+      tracemalloc.stop()
+
+  @contextlib.contextmanager
+  def measure(self, url, stage):
+    """
+    Measures the code executed in the context manager as the *stage* of the
+    page that is rendered for *url*, which may be #None.
+    """
+
+    stack = self._local.__dict__.setdefault('stack', [])
+    frame = [0.0, 0]  # Time and peak memory of nested stages.
+    stack.append(frame)
+    base = 0
+    if self.memory:
+      import tracemalloc
+      base = tracemalloc.get_traced_memory()[0]
+      tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      seconds = time.perf_counter() - start
+      peak = 0
+      if self.memory:
+        peak = max(tracemalloc.get_traced_memory()[1], frame[1])
+      stack.pop()
+      if stack:
+        stack[-1][0] += seconds
+        stack[-1][1] = max(stack[-1][1], peak)
+      self.add(url, stage, 1, seconds - frame[0], max(0, peak - base))
+
+  def add(self, url, stage, calls, seconds, peak):
+    with self._lock:
+      record = self._records.setdefault((url, stage), [0, 0.0, 0])
+      record[0] += calls
+      record[1] += seconds
+      record[2] = max(record[2], peak)
+
+  def pop(self, url):
+    """
+    Removes the records of *url* and returns them as a list of
+    `(url, stage, calls, seconds, peak)` tuples that can be passed to #add().
+    """
+
+    with self._lock:
+      keys = [k for k in self._records if k[0] == url]
+      return [k + tuple(self._records.pop(k)) for k in keys]
+
+  def report(self):
+    """
+    Returns the profile as a JSON serializable dictionary.
+    """
+
+    def entry(calls, seconds, peak):
+      result = {'calls': calls, 'seconds': round(seconds, 6)}
+      if self.memory:
+        result['peak_bytes'] = peak
+      return result
+
+    stages = {}
+    pages = {}
+    for (url, stage), (calls, seconds, peak) in self._records.items():
+      total = stages.setdefault(stage, [0, 0.0, 0])
+      total[0] += calls
+      total[1] += seconds
+      total[2] = max(total[2], peak)
+      pages.setdefault(url, {})[stage] = entry(calls, seconds, peak)
+
+    pages = [{'url': url, 'seconds': round(sum(x['seconds'] for x in v.values()), 6),
+              'stages': v} for url, v in pages.items()]
+    pages.sort(key=lambda x: -x['seconds'])
+    return {
+      'version': __version__,
+      'seconds': round(self.seconds, 6),
+      'memory': self.memory,
+      'stages': {k: entry(*v) for k, v in sorted(stages.items())},
+      'pages': pages,
+    }
+
+  def save(self, filename):
+    with io.open(filename, 'w', encoding='utf8') as fp:
+      json.dump(self.report(), fp, indent=2)
+
+  def print_summary(self, top=10):
+    """
+    Prints the time spent in each stage and the *top* slowest pages. The
+    share of a stage is relative to the time spent in all stages, which can
+    exceed the duration of the build if pages are rendered in parallel. Work
+    that does not belong to a page, like loading content in the site
+    template, is listed as `(build)`.
+    """
+
+    report = self.report()
+    total = sum(x['seconds'] for x in report['stages'].values()) or 1
+    print('build took {:.3f}s'.format(report['seconds']))
+    print('  {:<16} {:>7} {:>10} {:>7}'.format('stage', 'calls', 'seconds', 'share'))
+    for stage, data in sorted(report['stages'].items(), key=lambda x: -x[1]['seconds']):
+      line = '  {:<16} {:>7} {:>10.3f} {:>6.1f}%'.format(stage, data['calls'],
+        data['seconds'], 100.0 * data['seconds'] / total)
+      if self.memory:
+        line += '  peak {} KiB'.format(data['peak_bytes'] // 1024)
+      print(line)
+    print('  slowest pages:')
+    for page in report['pages'][:top]:
+      print('  {:>10.3f}s  {}'.format(page['seconds'], page['url'] or '(build)'))
+
+
+class RouteTable(object):
+  """
+  Resolves the URLs of a #Context. The URL format is read from the
+  configuration once when the table is created, and the results of all
+  conversions are cached. Relative URLs are cached per directory of the
+  source page, so that pages in the same directory share their results.
+
+  The table also collects the content references that were resolved while
+  rendering pages, which #find_broken_references() checks against the pages
+  and files of the build once it finished.
+
+  URLs of assets that were added with #add_asset() resolve to their
+  fingerprinted URL.
+  """
+
+  def __init__(self, url_format):
+    self.directory_format = (url_format == 'directory')
+    self.references = {}
+    self.assets = {}
+    self._real_urls = {}
+    self._filenames = {}
+    self._sources = {}
+    self._directories = {}
+    self._targets = {}
+    self._reference_cache = {}
+
+  def real_url(self, url, isfile=True):
+    key = (url, isfile)
+    try:
+      return self._real_urls[key]
+    except KeyError:
+      pass
+    if not url.startswith('/'):
+      raise ValueError('URL must start with a slash')
+    if url == '/':
+      result = '/' if self.directory_format else '/index.html'
+    else:
+      result = posixpath.normpath(url).rstrip('/')
+      if isfile and not self.directory_format:
+        result += '.html'
+    self._real_urls[key] = result
+    return result
+
+  def url_to_filename(self, url, isfile=True):
+    key = (url, isfile)
+    try:
+      return self._filenames[key]
+    except KeyError:
+      pass
+    result = self.real_url(url, isfile)
+    if result == '/':
+      result = 'index.html' if isfile else '/'
+    else:
+      result = result.lstrip('/')
+      if isfile and self.directory_format:
+        result += '/index.html'
+    self._filenames[key] = result
+    return result
+
+  def get_source_directory(self, source, isfile=True):
+    """
+    Returns a hashable key for the directory that relative URLs from
+    *source* are resolved from. #url_to() returns the same URLs for all
+    sources with the same key.
+    """
+
+    return self._get_source(source, isfile)[:2]
+
+  def _get_source(self, source, isfile):
+    try:
+      return self._sources[source, isfile]
+    except KeyError:
+      real_source = self.real_url(source, isfile)
+      directory = posixpath.dirname(real_source)
+      prefix = self.directory_format and real_source != '/'
+      cache = self._directories.setdefault((directory, prefix), {})
+      parts = tuple(x for x in directory.split('/') if x)
+      result = self._sources[source, isfile] = (directory, prefix, cache, parts)
+      return result
+
+  def _get_target(self, target, isfile):
+    # Returns the components of the real URL of *target*.
+    key = (target, isfile)
+    try:
+      return self._targets[key]
+    except KeyError:
+      pass
+    real_target = self.real_url(target, isfile)
+    if not isfile and real_target in self.assets:
+      real_target = self.assets[real_target]
+    result = self._targets[key] = tuple(x for x in real_target.split('/') if x)
+    return result
+
+  @staticmethod
+  def _relpath(target, directory):
+    # Same as posixpath.relpath() for the components of normalized paths.
+    common = 0
+    for a, b in zip(target, directory):
+      if a != b:
+        break
+      common += 1
+    return '/'.join(('..',) * (len(directory) - common) + target[common:]) or '.'
+
+  def url_to(self, target, source, isfile=True):
+    _, prefix, cache, directory = self._get_source(source, isfile)
+    key = (target, isfile)
+    try:
+      return cache[key]
+    except KeyError:
+      pass
+    result = self._relpath(self._get_target(target, isfile), directory)
+    if prefix:
+      result = '../' + result
+    cache[key] = result
+    return result
+
+  def urls_to(self, targets, source, isfile=True):
+    """
+    Returns a list of the relative URLs from *source* to all *targets* like
+    #url_to(), but without caching them per directory. Used to resolve the
+    URLs of all pages at once, eg. for a navigation, which would otherwise
+    add an entry for every page to the cache of every directory.
+    """
+
+    _, prefix, _, directory = self._get_source(source, isfile)
+    relpath, get_target = self._relpath, self._get_target
+    result = [relpath(get_target(x, isfile), directory) for x in targets]
+    if prefix:
+      result = ['../' + x for x in result]
+    return result
+
+  def resolve_reference(self, ref, source, isfile=None):
+    """
+    Returns a tuple of the relative URL for the content reference *ref* from
+    *source*, the absolute URL that it points to and whether it points to a
+    page.
+    """
+
+    key = (source, ref, isfile)
+    try:
+      return self._reference_cache[key]
+    except KeyError:
+      pass
+    if isfile is None:
+      isfile = not path.getsuffix(ref)
+    ref, fragment = ref.partition('#')[::2]
+    url = posixpath.join(source, ref)
+    result = self.url_to(url, source, isfile)
+    if fragment:
+      result += '#' + fragment
+    result = self._reference_cache[key] = (result, url, isfile)
+    return result
+
+  def add_asset(self, url, fingerprinted_url):
+    """
+    Adds an asset that is available at *url* and at *fingerprinted_url*.
+    Relative URLs to *url* resolve to *fingerprinted_url* from now on.
+    """
+
+    self.assets[self.real_url(url, False)] = fingerprinted_url
+    self._sources.clear()
+    self._directories.clear()
+    self._targets.clear()
+    self._reference_cache.clear()
+
+  def get_asset_url(self, url):
+    """
+    Returns the fingerprinted URL of the asset at *url*, or #None if *url*
+    is not an asset that was added with #add_asset().
+    """
+
+    return self.assets.get(self.real_url(url, False))
+
+  def add_references(self, url, references):
+    """
+    Sets the `(ref, url, isfile)` tuples of the references that were
+    resolved while rendering the page at *url*.
+    """
+
+    if references:
+      self.references[url] = references
+    else:
+      self.references.pop(url, None)
+
+  def find_broken_references(self, pages, copies):
+    """
+    Returns a list of `(url, ref)` tuples for the references that point
+    neither to one of the *pages* URLs nor to a file that was copied. The
+    *copies* are `(url, source, roots)` tuples like those that
+    #Context.collect_routes() returns.
+    """
+
+    targets = set(self.real_url(x) for x in pages)
+    copied = [(self.real_url(url, False).rstrip('/'), roots) for url, _, roots in copies]
+
+    def exists(url):
+      for prefix, roots in copied:
+        if url == prefix or url.startswith(prefix + '/'):
+          rel = url[len(prefix):].lstrip('/')
+          if any(path.exists(path.join(x, rel) if rel else x) for x in roots):
+            return True
+      return False
+
+    broken = []
+    for source in sorted(self.references):
+      for ref, url, isfile in self.references[source]:
+        if not url.startswith('/'):
+          continue
+        real_url = self.real_url(url, isfile)
+        if real_url not in targets and not exists(real_url):
+          broken.append((source, ref))
+    return broken
+
+
+class SearchIndex(object):
+  """
+  An inverted index of the pages of a site for client-side search. The terms
+  of every page are weighted by where they occur (title, headings or text)
+  and kept in a JSON file in the cache directory between builds, so that only
+  the pages that are rendered again need to be indexed again.
+
+  #get_files() produces the files for the build directory: `docs.json`,
+  which lists the `[url, title]` of every document by its ID, and one shard
+  per term prefix of *prefix_length* characters, which maps the terms to a
+  flat list of document IDs and scores. A client only needs to fetch the
+  shards for the prefixes of the terms it searches for. Prefixes that are
+  not lowercase ASCII letters and digits are hex-encoded and start with `_`.
+  """
+
+  VERSION = 1
+  TITLE_WEIGHT = 10
+  HEADING_WEIGHT = 5
+
+  _words = re.compile(r'\w{2,}', re.U)
+  _tags = re.compile(r'<[^>]*>')
+  _safe_prefix = re.compile(r'^[a-z0-9]+$')
+
+  def __init__(self, filename, prefix_length=2):
+    self.filename = filename
+    self.prefix_length = prefix_length
+    self.pages = {}
+    self.shards = []
+    self._next_id = 0
+    self._visited = set()
+    if path.isfile(filename):
+      with io.open(filename, encoding='utf8') as fp:
+        data = json.load(fp)
+      if data.get('version') == self.VERSION and data.get('prefixLength') == prefix_length:
+        self.pages = data['pages']
+        self.shards = data['shards']
+        self._next_id = data['nextId']
+
+  def begin(self):
+    self._visited = set()
+
+  def clear(self):
+    self.pages = {}
+    self.shards = []
+    self._next_id = 0
+    self._visited = set()
+
+  def save(self, prune=True):
+    if prune:
+      self.pages = {k: v for k, v in self.pages.items() if k in self._visited}
+    path.makedirs(path.dir(self.filename))
+    with io.open(self.filename, 'w', encoding='utf8') as fp:
+      json.dump({'version': self.VERSION, 'prefixLength': self.prefix_length,
+                 'pages': self.pages, 'shards': self.shards,
+                 'nextId': self._next_id}, fp)
+
+  @classmethod
+  def create_entry(cls, url, title, headings, html):
+    """
+    Creates the entry of a page from its real *url*, *title*, a list of its
+    *headings* and its *html*. Headings and the HTML may contain tags and
+    entities. May be called in a worker process.
+    """
+
+    import html as _html
+    terms = collections.Counter()
+    def add(text, weight):
+      text = _html.unescape(cls._tags.sub(' ', text))
+      for word in cls._words.findall(text.lower()):
+        terms[word] += weight
+    add(title, cls.TITLE_WEIGHT)
+    for heading in headings:
+      add(heading, cls.HEADING_WEIGHT)
+    add(html, 1)
+    return {'url': url, 'title': title, 'terms': dict(terms)}
+
+  def update(self, url, entry):
+    """
+    Sets the entry of the page at *url*, or removes it if *entry* is #None.
+    """
+
+    self._visited.add(url)
+    if entry is None:
+      self.pages.pop(url, None)
+      return
+    previous = self.pages.get(url)
+    self.pages[url] = dict(entry, id=previous['id'] if previous else None)
+
+  def visit(self, url):
+    self._visited.add(url)
+
+  def add_index(self, other):
+    """
+    Adds the pages of the #SearchIndex *other*, which are numbered again
+    when the files are produced. Used to merge the indexes of sharded builds.
+    """
+
+    for url, entry in other.pages.items():
+      self._visited.add(url)
+      self.pages[url] = dict(entry, id=None)
+
+  def get_shard_name(self, term):
+    prefix = term[:self.prefix_length]
+    if self._safe_prefix.match(prefix):
+      return prefix
+    return '_' + binascii.hexlify(prefix.encode('utf8')).decode('ascii')
+
+  def get_files(self):
+    """
+    Returns a dictionary that maps the names of the files of the index to
+    their data, and a list of the names of the shards that the previous call
+    returned, but this call did not.
+    """
+
+    # New pages are numbered in the order of their URLs, so that the IDs
+    # only depend on the pages, but not on the order they were rendered in.
+    for url in sorted(self.pages):
+      if self.pages[url]['id'] is None:
+        self.pages[url]['id'] = self._next_id
+        self._next_id += 1
+
+    docs = [None] * self._next_id
+    shards = {}
+    for entry in self.pages.values():
+      docs[entry['id']] = [entry['url'], entry['title']]
+      for term, score in entry['terms'].items():
+        shard = shards.setdefault(self.get_shard_name(term), {})
+        shard.setdefault(term, []).append((entry['id'], score))
+
+    def dump(value):
+      return json.dumps(value, separators=(',', ':'), sort_keys=True).encode('utf8')
+
+    files = {'docs.json': dump(docs)}
+    for name, terms in shards.items():
+      for term, postings in terms.items():
+        postings.sort(key=lambda x: (-x[1], x[0]))
+        terms[term] = [x for posting in postings for x in posting]
+      files[name + '.json'] = dump(terms)
+    stale = [x for x in self.shards if x not in shards]
+    self.shards = sorted(shards)
+    return files, stale
+
+
+_RenderResult = collections.namedtuple('_RenderResult',
+  'url message rendered entry files output references search')
+
+# The #Context and render queue that worker processes forked by
+# #Context._render_queued_pages() render pages from.
+_forked_render_queue = None
+
+
+def _save_pages_at_exit(ref):
+  context = ref()
+  if context is not None:
+    context.save_pages()
+
+
+def _render_forked(index):
+  context, queue = _forked_render_queue
+  url, template, vars = queue[index]
+  result = context._render_page(url, template, vars)
+  records = context.profiler.pop(url) if context.profiler else None
+  return result, records
+
+
+class _Dependencies(object):
+  """
+  Collects the inputs of a single #Context.render() call.
+  """
+
+  def __init__(self):
+    self.files = set()
+    self.directories = set()
+    self.config_keys = set()
+    self.references = []
+    self.contents = []
+    self.assets = {}
+
+
+class Context(object):
+  """
+  The context contains all information required for the rendering process.
+  """
+
+  def __init__(self, config, site_template, content_loader=None,
+               content_renderer=None, template_renderer=None):
+    if not isinstance(config, Config):
+      config = Config(config)
+    self.config = config
+    self.project_directory = '.'
+    self.site_template = site_template
+    self.content_loader = content_loader or MarkdownTomlContentLoader()
+    self.content_renderer = content_renderer or MarkdownJinjaContentRenderer()
+    self.template_renderer = template_renderer or JinjaTemplateRenderer()
+    self.globals = {}
+    self.content_registry = ContentRegistry()
+    self.manifest = None
+    self.full_build = False
+    self.profiler = None
+    self.io_pipeline = None
+    self.stats = collections.Counter()
+    self._local = threading.local()
+    self._render_queue = None
+    self._file_sync = None
+    self._page_writer = None
+    self._post_processors = None
+    self.search_index = None
+    self._in_build = False
+    self._pages_unsaved = False
+    self._save_at_exit = False
+    self._collecting = False
+    self._last_renders = collections.OrderedDict()
+    self._last_copies = []
+    self._page_dependencies = {}
+    self._content_fingerprints = None
+    self.config._access_hook = self._config_accessed
+
+    self.config.setdefault('statigen.urlFormat', 'file')
+    self.config.setdefault('statigen.contentDirectory', '.')
+    self.config.setdefault('statigen.buildDirectory', 'build')
+    self.config.setdefault('statigen.contentEncoding', 'utf8')
+    self.config.setdefault('statigen.siteEncoding', 'utf8')
+    self.config.setdefault('statigen.jobs', 1)
+    self.shard = parse_shard(self.config.get('statigen.shard'))
+
+    self.content_encoding = self.config['statigen.contentEncoding']
+    self.site_encoding = self.config['statigen.siteEncoding']
+    self.low_memory = self.config.get('statigen.lowMemory', False)
+    self.jobs = self.config['statigen.jobs'] or os.cpu_count() or 1
+    self.routes = RouteTable(self.config['statigen.urlFormat'])
+
+    self.site_template.init(self)
+
+  @property
+  def current_url(self):
+    """
+    The URL of the page that is currently being rendered in this thread.
+    """
+
+    return getattr(self._local, 'current_url', None)
+
+  @current_url.setter
+  def current_url(self, url):
+    self._local.current_url = url
+
+  @property
+  def template_vars(self):
+    """
+    The variables of the template that is currently being rendered in this
+    thread.
+    """
+
+    return getattr(self._local, 'template_vars', None)
+
+  @template_vars.setter
+  def template_vars(self, vars):
+    self._local.template_vars = vars
+
+  @property
+  def _dependencies(self):
+    return getattr(self._local, 'dependencies', None)
+
+  @_dependencies.setter
+  def _dependencies(self, dependencies):
+    self._local.dependencies = dependencies
+
+  def real_url(self, url, isfile=True):
+    """
+    Takes a basic URL and converts it to the real URL.
+    """
+
+    return self.routes.real_url(url, isfile)
+
+  def url_to_filename(self, url, isfile=True):
+    """
+    Takes a basic URL and converts it to the actualy filename relative to
+    the build directory.
+    """
+
+    return self.routes.url_to_filename(url, isfile)
+
+  def url_to_abs_filename(self, url, isfile=True):
+    build_dir = self.config['statigen.buildDirectory']
+    return path.canonical(self.url_to_filename(url, isfile), build_dir)
+
+  def url_to(self, target, source=None, isfile=True):
+    if source is None:
+      if self.current_url is None:
+        raise RuntimeError('Context.current_url is not set.')
+      source = self.current_url
+    if not isfile and self.routes.assets:
+      self._asset_referenced(target)
+    return self.routes.url_to(target, source, isfile)
+
+  def _asset_referenced(self, url):
+    # Pages that reference a fingerprinted asset must be rendered again if
+    # its fingerprinted URL changes, eg. because it was copied from another
+    # file or the file changed.
+    if self._dependencies is not None:
+      self._dependencies.assets[url] = self.routes.get_asset_url(url)
+
+  def content_reference_to_url(self, ref, source=None, isfile=None):
+    """
+    Transforms a content reference to a relative URL from *source* or the
+    Context's current URL. If *isfile* is #None (default), the type of the
+    reference will be determined automatically (content or asset). Results
+    are cached for the duration of a #build().
+
+    References that are resolved while a page is rendered are checked for
+    whether they point to a page or copied file after the build.
+    """
+
+    if not source:
+      if not self.current_url:
+        raise RuntimeError('no current URL')
+      source = self.current_url
+
+    result, url, isfile = self.routes.resolve_reference(ref, source, isfile)
+    dependencies = self._dependencies
+    if dependencies is not None:
+      dependencies.references.append((ref, url, isfile))
+      if not isfile and self.routes.assets:
+        self._asset_referenced(url)
+    return result
+
+  def build(self, full=False):
+    """
+    Builds the site by calling the site template's `render()` method. If the
+    `statigen.incremental` option is enabled, pages whose inputs did not
+    change since the previous build are skipped, unless *full* is #True.
+
+    If #jobs is greater than one, #render() calls are queued and the pages
+    are rendered in parallel once the site template finished. The output is
+    the same as that of a build with a single job.
+
+    If the `statigen.ioPipeline` option is enabled, content files are read
+    and pages are written by an #IOPipeline in the background.
+
+    If the `statigen.fingerprintAssets` option is enabled, pages are always
+    rendered after the site template finished, so that the fingerprinted
+    URLs of all copied files are known.
+
+    If the `statigen.shard` option is set to `I/N`, the site template is
+    rendered in full, but only the pages and copied files that belong to the
+    shard *I* of *N* are written (see #in_shard()). The build directories of
+    all shards are combined with #merge_builds(). The asset manifest and the
+    search index are not written by sharded builds, but by the merge.
+    """
+
+    if self.config.get('statigen.incremental', False) and self.manifest is None:
+      filename = path.join(self.get_cache_directory(), 'manifest.json')
+      self.manifest = BuildManifest(filename)
+    if self.manifest is not None:
+      self.manifest.begin()
+
+    self.full_build = full
+    self.stats = collections.Counter()
+    self.routes = RouteTable(self.config['statigen.urlFormat'])
+    self._last_renders.clear()
+    self._last_copies = []
+    self._page_dependencies = {}
+    self._content_fingerprints = None
+    self.content_loader.build_started(self)
+    self.content_renderer.build_started(self)
+    self.get_file_sync().begin()
+    self.get_page_writer().begin()
+    if self.config.get('statigen.searchIndex', False):
+      if self.search_index is None:
+        self.search_index = SearchIndex(
+          path.join(self.get_cache_directory(), 'search.json'),
+          self.config.get('statigen.searchPrefixLength', 2))
+      self.search_index.begin()
+    else:
+      self.search_index = None
+    if self.jobs > 1 or self.config.get('statigen.fingerprintAssets', False):
+      self._render_queue = []
+    if self.config.get('statigen.ioPipeline', False):
+      self.io_pipeline = IOPipeline(self.get_page_writer(),
+        max_open_files=self.config.get('statigen.maxOpenFiles', 64),
+        queue_size=self.config.get('statigen.writeQueueSize', 256))
+      self.io_pipeline.start()
+    self._in_build = True
+    failed = True
+    try:
+      self.site_template.render(self)
+      if self._render_queue:
+        self._render_queued_pages()
+      failed = False
+    finally:
+      self.full_build = False
+      self._render_queue = None
+      self._in_build = False
+      if self.io_pipeline is not None:
+        pipeline, self.io_pipeline = self.io_pipeline, None
+        try:
+          results = pipeline.stop()
+        except Exception:
+          # Don't replace the error that ended the build.
+          if not failed:
+            raise
+          results = ()
+        for result in results:
+          self._add_write_result(*result)
+
+    self.content_renderer.build_finished(self)
+    # In a sharded build, the shard that writes the index page also writes
+    # the asset manifest.
+    if self.config.get('statigen.fingerprintAssets', False) and self.in_shard('/'):
+      self._write_asset_manifest()
+    if self.search_index is not None:
+      self._write_search_index()
+    for filename in self.get_file_sync().prune():
+      print('removed stale file {}'.format(filename))
+    self.get_file_sync().save()
+    self._pages_unsaved = False
+    for filename in self.get_page_writer().save():
+      print('removed stale file {}'.format(filename))
+    if self.manifest is not None:
+      self.manifest.save()
+      print('{} page(s) rendered, {} skipped'.format(
+        self.stats['rendered'], self.stats['skipped']))
+    print('{} page(s) written, {} unchanged'.format(
+      self.stats['pages_written'], self.stats['pages_unchanged']))
+    if self.stats['derived_written'] or self.stats['derived_unchanged']:
+      print('{} derived file(s) written, {} unchanged'.format(
+        self.stats['derived_written'], self.stats['derived_unchanged']))
+    self._report_broken_references()
+    if self.low_memory:
+      peak = get_peak_memory()
+      if peak is not None:
+        print('peak memory: {:.1f} MiB (workers: {:.1f} MiB)'.format(
+          peak[0] / 1024.0 / 1024.0, peak[1] / 1024.0 / 1024.0))
+
+  async def build_async(self, full=False):
+    """
+    Runs #build() in a worker thread, so that it can be awaited without
+    blocking the event loop of an application that embeds Statigen.
+    """
+
+    import asyncio
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, functools.partial(self.build, full))
+
+  def rebuild(self, filenames):
+    """
+    Updates the site after the specified files changed, based on what the
+    previous #build() rendered and copied:
+
+    * Changes to files in a directory that was copied with #copy() only
+      cause that directory to be copied again, unless the
+      `statigen.fingerprintAssets` option is enabled.
+    * If only the body of a content file changed, the content is reloaded
+      and only the pages that depend on it are rendered again.
+
+    For any other change, including removed files, #build() is called,
+    which only renders the pages whose inputs changed if the build is
+    incremental.
+    """
+
+    if not self._last_renders and not self._last_copies:
+      return self.build()
+
+    copies = set()
+    contents = []
+    for filename in set(path.canonical(x) for x in filenames):
+      if not path.exists(filename):
+        return self.build()
+      matching = [i for i, (_, _, roots) in enumerate(self._last_copies)
+                  if any(filename == x or path.issub(path.rel(filename, x)) for x in roots)]
+      if matching:
+        # The fingerprinted URL of the file changes, and with it the pages
+        # that reference it and the asset manifest.
+        if self.config.get('statigen.fingerprintAssets', False):
+          return self.build()
+        copies.update(matching)
+        continue
+      found = self.content_registry.find(filename)
+      if not found:
+        return self.build()
+      contents += found
+
+    for content in contents:
+      fresh = self.content_loader.reload_content(self, content)
+      if fresh is None or fresh.sources != content.sources:
+        return self.build()
+      self.site_template.content_loaded(self, fresh)
+      if fingerprint(fresh.config) != self.content_registry.get_config_fingerprint(content):
+        return self.build()
+      content.body = fresh.body
+      self.content_registry.add(content)
+
+    self.stats = collections.Counter()
+    self._content_fingerprints = None
+    if contents:
+      if self.manifest is not None:
+        self.manifest.begin()
+      self.content_renderer.build_started(self)
+      filenames = set(x for c in contents for x in c.sources)
+      for url, (template, vars) in self._last_renders.items():
+        if filenames & self._page_dependencies.get(url, set()):
+          self._add_render_result(self._render_page(url, template, vars, echo=True))
+      if self.search_index is not None:
+        self._write_search_index(prune=False)
+      if self.manifest is not None:
+        self.manifest.save(prune=False)
+      self.get_page_writer().save(prune=False)
+      self._report_broken_references()
+    for index in sorted(copies):
+      url, source, _ = self._last_copies[index]
+      self.copy(url, source)
+
+  def render(self, __url, __template, **vars):
+    """
+    Renders a template for a URL into the build directory. During a #build()
+    with more than one job, the page is queued and rendered later.
+    """
+
+    if self._in_build or self._collecting:
+      self._last_renders[__url] = (__template, vars)
+    if self._collecting or not self.in_shard(__url):
+      return
+    if self._render_queue is not None:
+      self._render_queue.append((__url, __template, vars))
+    else:
+      self._add_render_result(self._render_page(__url, __template, vars, echo=True))
+      if not self._in_build:
+        self._save_pages_later()
+
+  def _save_pages_later(self):
+    # Saving writes the records of all pages, so pages that are rendered
+    # outside of a build are only saved once, by the next build or when the
+    # interpreter exits.
+    if not self._save_at_exit:
+      self._save_at_exit = True
+      atexit.register(_save_pages_at_exit, weakref.ref(self))
+    self._pages_unsaved = True
+
+  def save_pages(self):
+    """
+    Saves the records of the pages that were rendered with #render() outside
+    of a #build(). This happens automatically when the interpreter exits.
+    """
+
+    if self._pages_unsaved:
+      self._pages_unsaved = False
+      self.get_page_writer().save(prune=False)
+
+  def in_shard(self, key):
+    """
+    Returns #True if the page or file identified by *key* (its URL) is built
+    by this #shard, or if the build is not sharded.
+    """
+
+    if self.shard is None:
+      return True
+    index, count = self.shard
+    return int(hashlib.sha1(key.encode('utf8')).hexdigest()[:8], 16) % count == index
+
+  def get_content_fingerprints(self):
+    """
+    Returns the #fingerprint_contents() of the #content_registry, which is
+    used to fingerprint the variables of pages in incremental builds. It is
+    computed again when content was loaded since the last call, but not when
+    the attributes of content are changed after it was loaded.
+    """
+
+    cached = self._content_fingerprints
+    if cached is None or cached[0] != len(self.content_registry):
+      cached = (len(self.content_registry), fingerprint_contents(self.content_registry))
+      self._content_fingerprints = cached
+    return cached[1]
+
+  def _render_queued_pages(self):
+    global _forked_render_queue
+
+    queue, self._render_queue = self._render_queue, None
+    if self.manifest is not None:
+      # Computed once before the pages are rendered by the workers.
+      self.get_content_fingerprints()
+    jobs = min(self.jobs, len(queue))
+    if jobs <= 1:
+      for url, template, vars in queue:
+        self._add_render_result(self._render_page(url, template, vars, echo=True))
+      return
+    executor = self.site_template.get_render_executor(self)
+    if executor not in ('process', 'thread'):
+      raise ValueError('invalid render executor: {!r}'.format(executor))
+    import multiprocessing
+    if executor == 'process' and 'fork' not in multiprocessing.get_all_start_methods():
+      executor = 'thread'
+
+    if executor == 'process' and self.io_pipeline is not None:
+      self.io_pipeline.wait()
+    if executor == 'process' and any(not x.name.startswith(IOPipeline.THREAD_NAME)
+        for x in threading.enumerate() if x is not threading.current_thread()):
+      # Forking while other threads run (eg. the file observer in watch
+      # mode) may leave locks held in the workers.
+      executor = 'thread'
+
+    if executor == 'process':
+      _forked_render_queue = (self, queue)
+      try:
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+          for result, records in pool.imap(_render_forked, range(len(queue))):
+            for record in records or ():
+              self.profiler.add(*record)
+            self._add_render_result(result, True)
+      finally:
+        _forked_render_queue = None
+    else:
+      from concurrent.futures import ThreadPoolExecutor
+      with ThreadPoolExecutor(jobs) as pool:
+        for result in pool.map(lambda x: self._render_page(*x), queue):
+          self._add_render_result(result, True)
+
+  def profile(self, stage):
+    """
+    Returns a context manager that measures the code executed in it as the
+    *stage* of the page that is currently being rendered, if a #Profiler is
+    set. Does nothing otherwise.
+    """
+
+    if self.profiler is None:
+      return _null_profile
+    return self.profiler.measure(self.current_url, stage)
+
+  def _render_page(self, url, template, vars, echo=False):
+    """
+    Renders a single page and returns a #_RenderResult. This may be called
+    from a worker thread or process.
+    """
+
+    self.current_url = url
+    try:
+      filename = self.url_to_abs_filename(url)
+
+      vars_fingerprint = None
+      if self.manifest is not None:
+        vars_fingerprint = fingerprint(vars, self.globals,
+          contents=self.get_content_fingerprints())
+        if self.full_build:
+          reason = 'full build'
+        else:
+          reason = self.manifest.check(self, url, template, vars_fingerprint)
+        if not reason:
+          message = 'skipping {} ({}, up to date)'.format(filename, url)
+          if echo:
+            print(message)
+          return _RenderResult(url, message, False, None, None, None, None, None)
+        message = 'rendering {} ({}, {})'.format(filename, url, reason)
+      else:
+        message = 'rendering {} ({})'.format(filename, url)
+      if echo:
+        print(message)
+
+      self._dependencies = dependencies = _Dependencies()
+      dependencies.config_keys.add('statigen.urlFormat')
+      dependencies.config_keys.add('statigen.postProcessors')
+      try:
+        html = self._render_html(template, vars)
+        search = None
+        if self.search_index is not None and dependencies.contents:
+          with self.profile('search-index'):
+            search = self._create_search_entry(url, dependencies.contents[0])
+        if os.linesep != '\n':
+          html = html.replace('\n', os.linesep)
+        output = self._write_page(filename, html.encode(self.site_encoding))
+      finally:
+        self._dependencies = None
+
+      if self.low_memory:
+        for filename in dependencies.files:
+          content = self.content_registry.lookup(filename)
+          if content is not None:
+            content.release()
+
+      entry = None
+      files = self.template_renderer.get_template_dependencies(self, template)
+      if files is not None:
+        files = sorted(dependencies.files.union(files))
+      if self.manifest is not None:
+        entry = self.manifest.create_entry(self, template, vars_fingerprint,
+          filename, files, dependencies.directories, dependencies.config_keys,
+          dependencies.assets, dependencies.references)
+      return _RenderResult(url, message, True, entry, files, output,
+        dependencies.references, search)
+    finally:
+      self.current_url = None
+      self.template_vars = None
+
+  def _write_page(self, filename, data):
+    """
+    Post-processes the *data* of a page and writes it and the files derived
+    from it. Returns a list of `(filename, written, record)` tuples for the
+    files that were not written by the #io_pipeline.
+    """
+
+    writer = self.get_page_writer()
+    files = []
+    if self.get_post_processors():
+      with self.profile('post-process'):
+        data, _, files = self._post_process(filename, data, writer.is_derived_from)
+
+    output = []
+    with self.profile('write'):
+      pipeline = self.io_pipeline
+      if pipeline is None or pipeline.pid != os.getpid():
+        pipeline = None
+      for name, file_data, file_source in [(filename, data, None)] + files:
+        if file_data is None:
+          output.append((name, False, writer.files[name]))
+        elif pipeline is not None:
+          pipeline.write(name, file_data, file_source)
+        else:
+          output.append((name,) + writer.write(name, file_data, file_source))
+    return output
+
+  def _post_process(self, filename, data, is_derived_from):
+    """
+    Passes the *data* of *filename* through the #get_post_processors().
+    Returns the processed data, its SHA1 and a list of `(filename, data,
+    source)` tuples for the derived files, where *data* is #None if
+    `is_derived_from(filename, source)` returns #True.
+    """
+
+    processors = self.get_post_processors()
+    for processor in processors:
+      data = processor.process(self, filename, data)
+    source = hashlib.sha1(data).hexdigest()
+    files = []
+    for processor in processors:
+      for name, func in processor.get_derived_files(self, filename):
+        files.append((name, None if is_derived_from(name, source) else func(data), source))
+    return data, source, files
+
+  def get_post_processors(self):
+    """
+    Returns a list of the #PostProcessor objects that are configured with
+    the `statigen.postProcessors` option.
+    """
+
+    if self._post_processors is None:
+      names = self.config.get('statigen.postProcessors', [])
+      self._post_processors = [import_class(x)() for x in names]
+    return self._post_processors
+
+  def _create_search_entry(self, url, content):
+    headings = []
+    def walk(item):
+      for child in item.children:
+        headings.append(child.content)
+        walk(child)
+    walk(content.toc())
+    title = content.config.get('title', content.name)
+    return SearchIndex.create_entry(self.real_url(url), title, headings, content.render())
+
+  def _write_search_index(self, prune=True):
+    """
+    Writes the files of the #search_index into the `statigen.searchDirectory`
+    of the build directory and removes the shards that are no longer used.
+    """
+
+    if self.shard is not None:
+      # The indexes of all shards are combined by merge_builds().
+      self.search_index.save(prune)
+      return
+
+    directory = self.url_to_abs_filename(
+      '/' + self.config.get('statigen.searchDirectory', 'search'), False)
+    writer = self.get_page_writer()
+    files, stale = self.search_index.get_files()
+    for name, data in files.items():
+      filename = path.join(directory, name)
+      writer.update(filename, writer.write(filename, data)[1])
+    for name in stale:
+      filename = path.join(directory, name + '.json')
+      if path.isfile(filename):
+        os.remove(filename)
+    self.search_index.save(prune)
+
+  def _render_html(self, template, vars):
+    # Copied, the caller's variables are kept to re-render the page later.
+    vars = dict(vars)
+    vars.setdefault('context', self)
+    vars.setdefault('config', self.config)
+    vars.setdefault('url_to', self.url_to)
+    vars.setdefault('url_for', lambda x: self.url_to(x, isfile=False))
+    vars = collections.ChainMap(vars, self.globals)
+    with self.profile('template'):
+      return self.template_renderer.render_template(self, template, vars)
+
+  def render_to_string(self, url, template, vars):
+    """
+    Renders a template for a URL like #render(), but returns the HTML
+    instead of writing it to the build directory.
+    """
+
+    self.current_url = url
+    try:
+      return self._render_html(template, vars)
+    finally:
+      self.current_url = None
+      self.template_vars = None
+
+  def collect_routes(self):
+    """
+    Calls the site template's `render()` function without rendering pages or
+    copying files. Returns a dictionary that maps the URL of every page to a
+    `(template, vars)` tuple, and a list of `(url, source, roots)` tuples for
+    the #copy() calls, where *roots* are the files or directories that would
+    be copied (files in later roots take precedence).
+    """
+
+    self.routes = RouteTable(self.config['statigen.urlFormat'])
+    self._last_renders.clear()
+    self._last_copies = []
+    self.content_loader.build_started(self)
+    self.content_renderer.build_started(self)
+    self._collecting = True
+    try:
+      self.site_template.render(self)
+    finally:
+      self._collecting = False
+    return collections.OrderedDict(self._last_renders), list(self._last_copies)
+
+  def _add_render_result(self, result, echo=False):
+    if echo:
+      print(result.message)
+    self.stats['rendered' if result.rendered else 'skipped'] += 1
+    for output in result.output or ():
+      self._add_write_result(*output)
+    if not result.rendered:
+      filename = self.url_to_abs_filename(result.url)
+      self.get_page_writer().visit(filename)
+      for processor in self.get_post_processors():
+        for name, _ in processor.get_derived_files(self, filename):
+          self.get_page_writer().visit(name)
+    files, references = result.files, result.references
+    if self.manifest is not None:
+      self.manifest.visit(result.url, result.entry)
+      if not result.rendered:
+        # The references of skipped pages are checked as well.
+        entry = self.manifest.pages[result.url]
+        files = entry['files']
+        references = [tuple(x) for x in entry['references']]
+    self._page_dependencies[result.url] = set(files or ())
+    self.routes.add_references(result.url, references)
+    if self.search_index is not None:
+      if result.rendered:
+        self.search_index.update(result.url, result.search)
+      else:
+        self.search_index.visit(result.url)
+
+  def _report_broken_references(self):
+    broken = self.routes.find_broken_references(self._last_renders, self._last_copies)
+    if broken:
+      print('{} broken reference(s):'.format(len(broken)))
+      for url, ref in broken:
+        print('  {}: {}'.format(url, ref))
+
+  def _add_write_result(self, filename, written, record):
+    # Only the records of derived files have a source.
+    kind = 'derived' if len(record) > 3 else 'pages'
+    self.stats[kind + ('_written' if written else '_unchanged')] += 1
+    self.get_page_writer().update(filename, record)
+
+  def record_dependencies(self, filenames, content=None):
+    """
+    Records the specified *filenames* as inputs of the page that is currently
+    being rendered. Does nothing if no page is currently being rendered. The
+    *content* is passed by #Content.render(); the first content that is
+    rendered for a page is added to the #search_index.
+    """
+
+    if self._dependencies is not None:
+      self._dependencies.files.update(filenames)
+      if content is not None:
+        self._dependencies.contents.append(content)
+
+  def _config_accessed(self, key):
+    if self._dependencies is not None:
+      self._dependencies.config_keys.add(key)
+
+  def copy(self, url, source):
+    """
+    Copy the file or directory *source* from the site templates main directory
+    so that it is available from the specified URL.
+    """
+
+    if path.isabs(source):
+      choices = [source]
+    else:
+      parent_dirs = [self.site_template.get_main_directory(self)]
+      parent_dirs += [self.project_directory]
+      choices = [path.join(x, source) for x in parent_dirs]
+
+    if self._in_build or self._collecting:
+      roots = [path.canonical(x) for x in choices if path.exists(x)]
+      self._last_copies.append((url, source, roots))
+    if self._collecting:
+      return
+
+    target = self.url_to_abs_filename(url, False)
+    print('copying {} ==> {} ({})'.format(source, target, url))
+
+    with self.profile('copy'):
+      self._copy(url, target, choices)
+
+  def _copy(self, url, target, choices):
+    # Files from later choices take precedence.
+    files = collections.OrderedDict()
+    for current in choices:
+      if path.isfile(current):
+        print('  from {}'.format(current))
+        files[target] = current
+      elif path.isdir(current):
+        print('  from {}'.format(current))
+        for root, dirs, names in os.walk(current, followlinks=True):
+          dirs.sort()
+          for name in sorted(names):
+            filename = os.path.join(root, name)
+            files[path.join(target, path.rel(filename, current))] = filename
+
+    file_sync = self.get_file_sync()
+    if self.config.get('statigen.fingerprintAssets', False):
+      files.update(self._fingerprint(url, target, files))
+    if self.shard is not None:
+      build_dir = path.canonical(self.config['statigen.buildDirectory'])
+      files = {k: v for k, v in files.items()
+               if self.in_shard(path.rel(k, build_dir).replace(os.sep, '/'))}
+    pipeline = self.io_pipeline
+    process = key = None
+    if self.get_post_processors():
+      process = self._post_process_copy
+      key = fingerprint([type(x).__module__ + '.' + type(x).__qualname__
+                         for x in self.get_post_processors()])
+    stats = file_sync.sync([(v, k) for k, v in files.items()], self.full_build,
+      pipeline.map if pipeline is not None and pipeline.pid == os.getpid() else None,
+      process, key)
+    print('  {} file(s) copied ({} bytes), {} unchanged ({} bytes)'.format(
+      stats['copied'], stats['copied_bytes'], stats['unchanged'],
+      stats['unchanged_bytes']))
+    self.stats.update(stats)
+    if not self._in_build:
+      file_sync.save()
+
+  def _fingerprint(self, url, target, files):
+    """
+    Adds the files that are copied to *target* (available at *url*) to the
+    #routes as assets with the SHA1 of their source in the filename. Returns
+    a dictionary that maps the fingerprinted target files to their source.
+    """
+
+    fingerprinted = collections.OrderedDict()
+    for filename, source in files.items():
+      rel = path.rel(filename, target).replace(os.sep, '/')
+      file_url = url if rel == '.' else url.rstrip('/') + '/' + rel
+      base, suffix = posixpath.splitext(file_url)
+      if '/' in suffix:
+        base, suffix = file_url, ''
+      file_url_fp = '{}.{}{}'.format(base, self.get_file_sync().get_hash(source)[:10], suffix)
+      self.routes.add_asset(file_url, file_url_fp)
+      fingerprinted[self.url_to_abs_filename(file_url_fp, False)] = source
+    return fingerprinted
+
+  def _write_asset_manifest(self):
+    """
+    Writes the JSON file configured with `statigen.assetManifest` into the
+    build directory, which maps the URLs of all fingerprinted assets to their
+    fingerprinted URL.
+    """
+
+    data = json.dumps(self.routes.assets, indent=2, sort_keys=True).encode('utf8')
+    filename = self.url_to_abs_filename(
+      '/' + self.config.get('statigen.assetManifest', 'assets.json'), False)
+    writer = self.get_page_writer()
+    writer.update(filename, writer.write(filename, data)[1])
+
+  def _post_process_copy(self, filename):
+    # The target may be a hard link to the source, so it is only replaced,
+    # but never modified.
+    with open(filename, 'rb') as fp:
+      data = fp.read()
+    processed, _, files = self._post_process(filename, data, lambda *a: False)
+    if processed != data:
+      write_file_atomic(filename, processed, os.stat(filename).st_mode & 0o777)
+    for name, file_data, _ in files:
+      write_file_atomic(name, file_data, self.get_page_writer()._mode)
+    return [x[0] for x in files]
+
+  def get_file_sync(self):
+    """
+    Returns the #FileSync that is used by #copy(). It is configured with the
+    `statigen.copyMethod` and `statigen.copyCompare` options.
+    """
+
+    if self._file_sync is None:
+      self._file_sync = FileSync(
+        path.join(self.get_cache_directory(), 'copies.json'),
+        method=self.config.get('statigen.copyMethod', 'copy'),
+        compare=self.config.get('statigen.copyCompare', 'mtime'),
+        jobs=self.jobs)
+    return self._file_sync
+
+  def get_page_writer(self):
+    """
+    Returns the #PageWriter that is used to write rendered pages.
+    """
+
+    if self._page_writer is None:
+      self._page_writer = PageWriter(path.join(self.get_cache_directory(), 'pages.json'))
+    return self._page_writer
+
+  def copy_assets(self, url, content):
+    """
+    Copy the assets associated with the specified #Content object to the
+    static output directory for *url*. The URL should be the same that the
+    #Content was rendered with.
+    """
+
+    if path.exists(content.assets):
+      self.copy(url, path.abs(content.assets))
+
+  def load_content_from_directory(self, directory):
+    if not path.isabs(directory):
+      content_directory = self.config['statigen.contentDirectory']
+      directory = path.join(content_directory, directory)
+    if self._dependencies is not None:
+      self._dependencies.directories.add(path.canonical(directory))
+    result = []
+    with self.profile('load'):
+      for content in self.content_loader.load_content_from_directory(self, directory):
+        self._content_loaded(content)
+        result.append(content)
+    return result
+
+  def has_content_directory(self, directory):
+    """
+    Returns #True if the *directory*, relative to the content directory,
+    exists. Use this instead of catching the #FileNotFoundError raised by
+    #load_content_from_directory(), as the content loader may be able to
+    answer this from an index without accessing the file system.
+    """
+
+    if not path.isabs(directory):
+      directory = path.join(self.config['statigen.contentDirectory'], directory)
+    return self.content_loader.has_directory(self, directory)
 
   def load_content(self, name):
-    content = self.content_loader.load_content(self, name)
-    self.site_template.content_loaded(self, content)
+    with self.profile('load'):
+      content = self.content_loader.load_content(self, name)
+      self._content_loaded(content)
     return content
 
+  def _content_loaded(self, content):
+    # Content returned from the registry has already been seen.
+    if content not in self.content_registry:
+      with self.profile('content_loaded'):
+        self.site_template.content_loaded(self, content)
+      self.content_registry.add(content)
+    self.record_dependencies(content.sources)
+
   def get_template_directory(self):
     return self.site_template.get_template_directory(self)
 
+  def get_cache_directory(self):
+    """
+    Returns the directory in which caches that persist between builds are
+    stored. Defaults to the `.statigen/` directory inside the build directory.
+    In a sharded build, a configured `statigen.cacheDirectory` is scoped to
+    the shard with #get_shard_cache_directory(), as the shards may share it.
+    """
+
+    directory = self.config.get('statigen.cacheDirectory')
+    if directory:
+      return get_shard_cache_directory(directory, self.shard)
+    return path.join(self.config['statigen.buildDirectory'], '.statigen')
+
+
+def merge_builds(directories, target, search_directory='search', cache_directory=None):
+  """
+  Merges the build directories of the shards of a sharded build (see
+  `statigen.shard`) into the *target* directory. No two shards may have
+  written the same file. Returns a list of `(filename, directories)` tuples
+  for the files written by more than one shard, in which case nothing is
+  merged.
+
+  The search indexes in the cache directories of the shards are combined
+  and written to the *search_directory* in the *target*. The cache
+  directories are the `.statigen` directories of the shards, or the shard
+  subdirectories of the *cache_directory* if the shards were built with a
+  `statigen.cacheDirectory` (see #get_shard_cache_directory()).
+  """
+
+  owners = collections.OrderedDict()
+  for directory in directories:
+    for root, dirs, names in os.walk(directory):
+      if root == directory and '.statigen' in dirs:
+        dirs.remove('.statigen')
+      dirs.sort()
+      for name in sorted(names):
+        rel = path.rel(os.path.join(root, name), directory)
+        owners.setdefault(rel, []).append(directory)
+
+  conflicts = [(k, v) for k, v in owners.items() if len(v) > 1]
+  if conflicts:
+    return conflicts
+
+  for rel, (directory,) in owners.items():
+    filename = path.join(target, rel)
+    path.makedirs(path.dir(filename))
+    shutil.copy2(path.join(directory, rel), filename)
+
+  if cache_directory:
+    count = len(directories)
+    cache_directories = [get_shard_cache_directory(cache_directory, (i, count))
+                         for i in range(count)]
+  else:
+    cache_directories = [path.join(x, '.statigen') for x in directories]
+    cache_directory = path.join(target, '.statigen')
+
+  index = None
+  for directory in cache_directories:
+    filename = path.join(directory, 'search.json')
+    if path.isfile(filename):
+      with io.open(filename, encoding='utf8') as fp:
+        prefix_length = json.load(fp).get('prefixLength', 2)
+      if index is None:
+        index = SearchIndex(path.join(cache_directory, 'search.json'), prefix_length)
+        index.clear()
+      index.add_index(SearchIndex(filename, prefix_length))
+  if index is not None:
+    files, _ = index.get_files()
+    for name, data in files.items():
+      write_file_atomic(path.join(target, search_directory, name), data)
+
+  return []
+
+
+class Watcher(object):
+  """
+  Watches the content directory, the site template's main directory and the
+  project directory for changes and passes the changed files to the
+  *callback*, which defaults to #Context.rebuild(). Events are coalesced until no new event arrived for
+  *debounce* seconds. Changes in the build and cache directories are ignored.
+  """
+
+  def __init__(self, context, debounce=0.1, callback=None):
+    self.context = context
+    self.debounce = debounce
+    self.callback = callback or context.rebuild
+
+  def get_directories(self):
+    """
+    Returns the directories to watch. Directories that are inside another
+    watched directory are omitted, as all directories are watched recursively.
+    """
+
+    context = self.context
+    directories = [
+      context.config['statigen.contentDirectory'],
+      context.site_template.get_main_directory(context),
+      context.project_directory]
+    result = []
+    for directory in sorted(set(path.canonical(x) for x in directories), key=len):
+      if not any(directory == x or path.issub(path.rel(directory, x)) for x in result):
+        result.append(directory)
+    return result
+
+  def is_ignored(self, filename):
+    for directory in (self.context.config['statigen.buildDirectory'],
+                      self.context.get_cache_directory()):
+      directory = path.canonical(directory)
+      if filename == directory or path.issub(path.rel(filename, directory)):
+        return True
+    return False
+
+  def run(self):
+    """
+    Watches for changes until the process is interrupted.
+    """
+
+    import queue, time, traceback
+    import watchdog.events, watchdog.observers
+
+    events = queue.Queue()
+    watcher = self
+
+    class Handler(watchdog.events.FileSystemEventHandler):
+      def on_any_event(self, event):
+        # Newer versions of watchdog also report files being opened and
+        # closed, which happens when we read them during the rebuild.
+        if event.event_type not in ('created', 'deleted', 'modified', 'moved'):
+          return
+        if event.is_directory and event.event_type == 'modified':
+          return
+        for filename in (event.src_path, getattr(event, 'dest_path', None)):
+          if filename:
+            filename = path.canonical(filename)
+            if not watcher.is_ignored(filename):
+              events.put(filename)
+
+    observer = watchdog.observers.Observer()
+    for directory in self.get_directories():
+      observer.schedule(Handler(), path=directory, recursive=True)
+    observer.start()
+    try:
+      while True:
+        changed = set([events.get()])
+        deadline = time.monotonic() + self.debounce
+        while True:
+          try:
+            changed.add(events.get(timeout=max(0, deadline - time.monotonic())))
+          except queue.Empty:
+            break
+          deadline = time.monotonic() + self.debounce
+        print()
+        print('{} file(s) changed, updating ...'.format(len(changed)))
+        print()
+        start = time.perf_counter()
+        try:
+          self.callback(changed)
+        except Exception:
+          traceback.print_exc()
+        else:
+          print('updated in {:.0f} ms'.format((time.perf_counter() - start) * 1000))
+    finally:
+      observer.stop()
+      observer.join()
+
+
+class DevServer(object):
+  """
+  Serves the site over HTTP without building it. The site template's
+  `render()` function is called with #Context.collect_routes() to find the
+  pages, and a page is only rendered when it is requested. Rendered pages are
+  kept in memory until a file watched by a #Watcher changes. Files that the
+  site template copies are served from their source.
+  """
+
+  def __init__(self, context, host='127.0.0.1', port=8000, debounce=0.1):
+    self.context = context
+    self.host = host
+    self.port = port
+    self.debounce = debounce
+    self._lock = threading.RLock()
+    self._routes = None
+    self._copies = None
+    self._cache = {}
+
+  def invalidate(self, filenames=None):
+    """
+    Drops all rendered pages. The routes are collected again on the next
+    request.
+    """
+
+    with self._lock:
+      self._routes = None
+      self._copies = None
+      self._cache.clear()
+
+  def _collect(self):
+    routes, copies = self.context.collect_routes()
+    build_dir = path.canonical(self.context.config['statigen.buildDirectory'])
+    def request_path(url, isfile=True):
+      filename = self.context.url_to_abs_filename(url, isfile)
+      return '/' + path.rel(filename, build_dir).replace(os.sep, '/')
+    self._routes = {request_path(k): (k,) + v for k, v in routes.items()}
+    self._copies = [(request_path(url, False).rstrip('/'), roots) for url, _, roots in copies]
+
+  def get(self, request_path):
+    """
+    Returns the content type and data for the requested path, or #None if
+    the site has no such file.
+    """
+
+    from urllib.parse import unquote, urlparse
+    request_path = posixpath.normpath('/' + unquote(urlparse(request_path).path).lstrip('/'))
+    candidates = [request_path]
+    if not request_path.endswith('.html'):
+      candidates.append(request_path.rstrip('/') + '/index.html')
+
+    with self._lock:
+      if self._routes is None:
+        self._collect()
+      for candidate in candidates:
+        if candidate in self._cache:
+          return self._cache[candidate]
+        if candidate in self._routes:
+          url, template, vars = self._routes[candidate]
+          print('rendering {} ({})'.format(candidate, url))
+          html = self.context.render_to_string(url, template, vars)
+          encoding = self.context.site_encoding
+          result = ('text/html; charset=' + encoding, html.encode(encoding))
+          self._cache[candidate] = result
+          return result
+      copies = self._copies
+
+    import mimetypes
+    for prefix, roots in reversed(copies):
+      if request_path != prefix and not request_path.startswith(prefix + '/'):
+        continue
+      rel = request_path[len(prefix) + 1:]
+      for root in reversed(roots):
+        filename = path.join(root, rel) if rel else root
+        if path.isfile(filename):
+          with open(filename, 'rb') as fp:
+            data = fp.read()
+          return (mimetypes.guess_type(filename)[0] or 'application/octet-stream', data)
+    return None
+
+  def run(self, open_browser=False):
+    """
+    Serves the site and watches for changes until the process is
+    interrupted. If *open_browser* is #True, the index page is opened in the
+    web browser once the server is listening.
+    """
+
+    import http.server, traceback
+    server = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self, send_body=True):
+        try:
+          result = server.get(self.path)
+        except Exception:
+          result = None
+          status, data = 500, traceback.format_exc().encode('utf8')
+          content_type = 'text/plain; charset=utf8'
+          traceback.print_exc()
+        else:
+          if result is None:
+            status, data = 404, b'Not found'
+            content_type = 'text/plain; charset=utf8'
+          else:
+            status = 200
+            content_type, data = result
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if send_body:
+          self.wfile.write(data)
+
+      def do_HEAD(self):
+        self.do_GET(send_body=False)
+
+    watcher = Watcher(self.context, self.debounce, self.invalidate)
+    threading.Thread(target=watcher.run, daemon=True).start()
+    httpd = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+    address = 'http://{}:{}/'.format(self.host, httpd.server_address[1])
+    print('serving at {}'.format(address))
+    if open_browser:
+      import webbrowser
+      webbrowser.open(address)
+    try:
+      httpd.serve_forever()
+    finally:
+      httpd.server_close()
+
 
 ##
 # Generic helpers
 ##
 
+# Returned by #Context.profile() if profiling is disabled.
+_null_profile = contextlib.nullcontext()
+
+def get_peak_memory():
+  """
+  Returns the peak resident set size of the current process and of its
+  largest terminated child process in bytes, or #None if it can not be
+  determined on this platform.
+  """
+
+  try:
+    import resource
+  except ImportError:
+    return None
+  scale = 1 if sys.platform == 'darwin' else 1024
+  return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def get_default_file_mode():
+  """
+  Returns the permissions of new files with the process' umask applied.
+  """
+
+  # The umask can only be read by setting it.
+  umask = os.umask(0)
+  os.umask(umask)
+  return 0o666 & ~umask
+
+
+def write_file_atomic(filename, data, mode=None):
+  """
+  Writes the bytes *data* to a temporary file in the directory of *filename*
+  and moves it into place, so that a partially written file is never
+  visible. If *filename* is a hard link, the other links keep their content.
+  The file gets the permissions *mode*, or #get_default_file_mode().
+  """
+
+  if mode is None:
+    mode = get_default_file_mode()
+  directory = path.dir(filename)
+  path.makedirs(directory)
+  fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + path.base(filename), suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as fp:
+      fp.write(data)
+    os.chmod(tmp, mode)
+    os.replace(tmp, filename)
+  except BaseException:
+    os.remove(tmp)
+    raise
+
+
+def parse_shard(value):
+  """
+  Parses a shard specification in the form `I/N` (where `1 <= I <= N`) and
+  returns a tuple of the zero-based index and the number of shards, or #None
+  if *value* is #None.
+  """
+
+  if value is None:
+    return None
+  try:
+    index, count = map(int, str(value).split('/'))
+  except ValueError:
+    raise ValueError('invalid shard: {!r}'.format(value))
+  if not 1 <= index <= count:
+    raise ValueError('invalid shard: {!r}'.format(value))
+  return index - 1, count
+
+
+def get_shard_cache_directory(directory, shard):
+  """
+  Returns the subdirectory of the cache *directory* that is used by the
+  *shard* returned by #parse_shard(), or *directory* if *shard* is #None.
+  """
+
+  if shard is None:
+    return directory
+  return path.join(directory, 'shard-{}-of-{}'.format(shard[0] + 1, shard[1]))
+
+
 def import_class(name):
   module, class_ = name.rpartition('.')[::2]
   return getattr(__import__(module, fromlist=[None]), class_)
 
 
+def fingerprint(*values, contents=None, _refs=None):
+  """
+  Computes a SHA1 hex digest of the specified *values* that is stable between
+  builds. Containers are hashed recursively. #Content objects are represented
+  by their filename, configuration and public attributes, but not their body.
+  Objects that have no stable representation, and objects whose class sets
+  `__fingerprint__ = False`, are represented by their type.
+
+  *contents* may be a dictionary returned by #fingerprint_contents(). The
+  #Content objects in it are represented by their precomputed fingerprint
+  instead of being hashed again.
+  """
+
+  hasher = hashlib.sha1()
+  seen = set()
+
+  def write(*parts):
+    for part in parts:
+      hasher.update(part.encode('utf8'))
+
+  def update(value):
+    if value is None or isinstance(value, (bool, int, float, six.string_types,
+        bytes, datetime.date, datetime.time, datetime.timedelta)):
+      write(repr(value), ';')
+    elif isinstance(value, Context):
+      write('Context;')
+    elif isinstance(value, Config):
+      update(value._data)
+    elif isinstance(value, Content):
+      if contents is not None and id(value) in contents:
+        write('Content#', contents[id(value)], ';')
+        return
+      if id(value) in seen or (_refs is not None and seen):
+        # With _refs, only the first Content is hashed and the Content that
+        # it references are collected.
+        if _refs is not None:
+          _refs.append(value)
+        write('Content@', value.filename, ';')
+        return
+      seen.add(id(value))
+      write('Content(')
+      update({k: v for k, v in value._attributes().items()
+              if not k.startswith('_') and k != 'context'})
+      write(')')
+    elif isinstance(value, collections.abc.Mapping):
+      write('{')
+      for key in sorted(value.keys(), key=repr):
+        update(key)
+        update(value[key])
+      write('}')
+    elif isinstance(value, (list, tuple)):
+      write('[')
+      for item in value:
+        update(item)
+      write(']')
+    elif isinstance(value, (set, frozenset)):
+      write('{', ','.join(sorted(fingerprint(x) for x in value)), '}')
+    elif hasattr(value, '__qualname__'):
+      write(getattr(value, '__module__', None) or '', '.', value.__qualname__, ';')
+    elif getattr(type(value), '__fingerprint__', True) is False:
+      write(type(value).__qualname__, ';')
+    elif hasattr(value, '__dict__'):
+      if id(value) in seen:
+        write('@;')
+        return
+      seen.add(id(value))
+      write(type(value).__qualname__, '(')
+      update(vars(value))
+      write(')')
+    else:
+      text = repr(value)
+      if ' at 0x' in text:
+        text = type(value).__qualname__
+      write(text, ';')
+
+  for value in values:
+    update(value)
+  return hasher.hexdigest()
+
+
+def fingerprint_contents(contents):
+  """
+  Computes the fingerprints of the #Content objects in *contents* and the
+  #Content objects that they reference through their attributes (eg. the
+  `parent` and `children` of a page tree). Returns a dictionary that maps the
+  `id()` of every #Content to its fingerprint, for the *contents* argument of
+  #fingerprint().
+
+  Every #Content is hashed once. Content that is connected through its
+  attributes shares the fingerprint of its group in addition to its own, so
+  that the fingerprint of a page in a tree still changes if any page in the
+  tree changes, without walking the tree again for every fingerprint.
+  """
+
+  contents = list(contents)
+  index = {id(x): i for i, x in enumerate(contents)}
+  groups = list(range(len(contents)))
+
+  def find(i):
+    while groups[i] != i:
+      groups[i] = groups[groups[i]]
+      i = groups[i]
+    return i
+
+  own = []
+  for i, content in enumerate(contents):  # contents grows while iterating
+    refs = []
+    own.append(fingerprint(content, _refs=refs))
+    for ref in refs:
+      if id(ref) not in index:
+        index[id(ref)] = len(contents)
+        groups.append(len(contents))
+        contents.append(ref)
+      groups[find(index[id(ref)])] = find(i)
+
+  members = {}
+  for i in range(len(contents)):
+    members.setdefault(find(i), []).append(i)
+  result = {}
+  for group in members.values():
+    digest = fingerprint(sorted(own[i] for i in group))
+    for i in group:
+      result[id(contents[i])] = own[i] + digest
+  return result
+
+
 ##
 # Main
 ##
@@ -611,22 +4030,41 @@ def import_class(name):
 def get_argument_parser(prog=None):
   import argparse
   parser = argparse.ArgumentParser(prog=prog)
+  parser.add_argument('command', nargs='?', choices=['build', 'serve', 'merge'], default='build', help='Build the site (default), serve it with a local HTTP server that renders pages when they are requested, or merge the build directories of a sharded build into the build directory.')
+  parser.add_argument('directories', nargs='*', help='The build directories of the shards to merge.')
   parser.add_argument('--version', action='version', version=__version__, help='Display the version and exit.')
   parser.add_argument('-c', '--config', help='Alternative configuration file.')
   parser.add_argument('-b', '--build-directory', help='Override build directory.')
   parser.add_argument('-t', '--template', help='Override template name.')
   parser.add_argument('-o', '--open', action='store_true', help='Open the index page after the build completed.')
-  parser.add_argument('-w', '--watch', action='store_true', help='Watch for changes and rebuild as soon as they are registered.')
+  parser.add_argument('--host', default='127.0.0.1', help='The address to serve the site on. Default: 127.0.0.1')
+  parser.add_argument('-p', '--port', type=int, default=8000, help='The port to serve the site on. Default: 8000')
+  parser.add_argument('-w', '--watch', action='store_true', help='Watch for changes and rebuild as soon as they are registered. Implies --incremental.')
+  parser.add_argument('--debounce', type=float, help='Seconds to wait for more changes before rebuilding in watch mode. Default: 0.1')
+  parser.add_argument('-i', '--incremental', action='store_true', help='Only render pages whose inputs changed since the previous build.')
+  parser.add_argument('--full', action='store_true', help='Render all pages, even if the build is incremental.')
+  parser.add_argument('-j', '--jobs', type=int, help='Number of pages to render in parallel. Pass 0 to use all CPU cores.')
+  parser.add_argument('--low-memory', action='store_true', help='Release content and rendered HTML once a page is written to keep the memory usage flat.')
+  parser.add_argument('--shard', metavar='I/N', help='Only write the pages and files of the I-th of N shards. Combine the shards with "merge".')
+  parser.add_argument('--io-pipeline', action='store_true', help='Read content and write pages in the background while rendering.')
+  parser.add_argument('--profile', metavar='FILE', help='Measure the time spent in each stage of the build per page, write the report to FILE as JSON and print a summary.')
+  parser.add_argument('--profile-memory', action='store_true', help='Also measure the peak memory of each stage with --profile.')
   return parser
 
 
 def main(argv=None, prog=None):
   parser = get_argument_parser(prog)
-  args = parser.parse_args(argv)
+  # Allows options between the command and the directories to merge.
+  args = parser.parse_intermixed_args(argv)
+  if args.command == 'merge' and not args.directories:
+    parser.error('merge requires the build directories of the shards')
+  if args.command != 'merge' and args.directories:
+    parser.error('unrecognized arguments: ' + ' '.join(args.directories))
 
   if not args.config and path.isfile('.statigen.toml'):
     args.config = '.statigen.toml'
   if args.config:
+    import toml
     with open(args.config) as fp:
       config = toml.load(fp)
   else:
@@ -637,8 +4075,34 @@ def main(argv=None, prog=None):
     config['statigen.buildDirectory'] = args.build_directory
   if args.template:
     config['statigen.template'] = args.template
-
-  site_template = PythonSiteTemplate.load(config.get('statigen.template', 'default/docs'))
+  if args.incremental or args.watch:
+    config['statigen.incremental'] = True
+  if args.io_pipeline:
+    config['statigen.ioPipeline'] = True
+  if args.low_memory:
+    config['statigen.lowMemory'] = True
+  if args.debounce is not None:
+    config['statigen.watchDebounce'] = args.debounce
+  if args.jobs is not None:
+    config['statigen.jobs'] = args.jobs
+  if args.shard:
+    config['statigen.shard'] = args.shard
+
+  if args.command == 'merge':
+    conflicts = merge_builds(args.directories, config.get('statigen.buildDirectory', 'build'),
+                             config.get('statigen.searchDirectory', 'search'),
+                             config.get('statigen.cacheDirectory'))
+    for filename, directories in conflicts:
+      print('conflict: {} written by {}'.format(filename, ', '.join(directories)))
+    return 1 if conflicts else 0
+
+  cache_dir = config.get('statigen.cacheDirectory')
+  if cache_dir:
+    cache_dir = get_shard_cache_directory(cache_dir, parse_shard(config.get('statigen.shard')))
+  else:
+    cache_dir = path.join(config.get('statigen.buildDirectory', 'build'), '.statigen')
+  site_template = PythonSiteTemplate.load(
+    config.get('statigen.template', 'default/docs'), cache_dir=cache_dir)
   context = Context(
     config = config,
     site_template = site_template,
@@ -646,39 +4110,28 @@ def main(argv=None, prog=None):
     content_renderer = import_class(config.get('contentRenderer', __name__ + '.MarkdownJinjaContentRenderer'))(),
     template_renderer = import_class(config.get('templateRenderer', __name__ + '.JinjaTemplateRenderer'))()
   )
-  site_template.render(context)
+
+  if args.command == 'serve':
+    server = DevServer(context, args.host, args.port, config.get('statigen.watchDebounce', 0.1))
+    server.run(open_browser=args.open)
+    return
+
+  if args.profile:
+    context.profiler = Profiler(memory=args.profile_memory)
+    context.profiler.start()
+  context.build(full=args.full)
+  if args.profile:
+    context.profiler.stop()
+    context.profiler.save(args.profile)
+    context.profiler.print_summary()
+    context.profiler = None
 
   if args.open:
     import webbrowser
     webbrowser.open(path.join(config['statigen.buildDirectory'], 'index.html'))
 
   if args.watch:
-    import time, threading
-    import watchdog.events, watchdog.observers
-    build_dir = path.abs(config['statigen.buildDirectory'])
-    changed = threading.Event()
-    class Handler(watchdog.events.FileSystemEventHandler):
-      def on_any_event(self, event):
-        rel = path.rel(path.abs(event.src_path), build_dir)
-        if not path.issub(rel):  # Not an event in the build directory
-          changed.set()
-    observer = watchdog.observers.Observer()
-    observer.schedule(Handler(), path=config['statigen.contentDirectory'], recursive=True)
-    observer.schedule(Handler(), path=context.site_template.get_main_directory(context), recursive=True)
-    observer.schedule(Handler(), path=context.project_directory, recursive=True)
-    observer.start()
-    try:
-      while True:
-        if changed.is_set():
-          print()
-          print('File changed, rebuilding ...')
-          print()
-          site_template.render(context)
-          changed.clear()
-        time.sleep(0.1)
-    finally:
-      observer.stop()
-    observer.join()
+    Watcher(context, config.get('statigen.watchDebounce', 0.1)).run()
 
 _entry_point = lambda: sys.exit(main())
 
@@ -1,4 +1,5 @@
 
+import re
 from datetime import datetime
 
 def init(context):
@@ -8,6 +9,106 @@ def content_loaded(context, content):
   if 'date' in content.config:
     content.config['date'] = datetime.strptime(content.config['date'], '%Y-%m-%d')
 
+def _load_posts(context, posts_dir):
+  posts = context.load_content_from_directory(posts_dir)
+  posts = [x for x in posts if not x.config.get('draft')]
+  now = datetime.now()
+  posts.sort(key=lambda p: p.config.get('date', now), reverse=True)
+  return posts
+
+def _tag_slug(tag):
+  return re.sub(r'[^\w]+', '-', tag.lower()).strip('-')
+
+def _tag_slugs(tags):
+  """
+  Returns a dictionary that maps the lowercase *tags* to unique slugs. Tags
+  with the same slug (eg. `c` and `c++`) get a numeric suffix in their sorted
+  order.
+  """
+
+  slugs, used = {}, set()
+  for tag in sorted(tags):
+    slug = base = _tag_slug(tag)
+    number = 2
+    while slug in used:
+      slug = '{}-{}'.format(base, number)
+      number += 1
+    used.add(slug)
+    slugs[tag] = slug
+  return slugs
+
+def _paginate(posts, per_page):
+  if not per_page or per_page <= 0:
+    return [posts]
+  return [posts[i:i + per_page] for i in range(0, len(posts), per_page)] or [[]]
+
+def _render_listing(context, url, posts, per_page, **vars):
+  """
+  Renders the *posts* to `blog.html` at *url*. If *per_page* is set, only
+  that many posts are rendered per page and the following pages are
+  rendered at `<url>/page/<n>`.
+  """
+
+  chunks = _paginate(posts, per_page)
+  page_url = lambda n: url if n == 1 else '{}/page/{}'.format(url.rstrip('/'), n)
+  for number, chunk in enumerate(chunks, 1):
+    pagination = {
+      'number': number,
+      'prev_url': page_url(number - 1) if number > 1 else None,
+      'next_url': page_url(number + 1) if number < len(chunks) else None,
+    }
+    context.render(page_url(number), 'blog.html', posts=chunk,
+                   pagination=pagination, **vars)
+
+def _render_blog(context, page, posts):
+  """
+  Renders the listing of the blog *page*, its posts and, if enabled, the
+  archive and tag pages. All listings are slices of the same sorted list of
+  *posts*, so a listing page only changes if its posts changed.
+  """
+
+  base = page.config['url'].rstrip('/')
+  per_page = page.config.get('postsPerPage', context.config.get('site.postsPerPage'))
+
+  years, months, tags = {}, {}, {}
+  for post in posts:
+    date = post.config.get('date')
+    if date is not None:
+      years.setdefault(date.year, []).append(post)
+      months.setdefault((date.year, date.month), []).append(post)
+    for tag in post.config.get('tags', []):
+      tags.setdefault(tag.lower(), (tag, []))[1].append(post)
+  slugs = _tag_slugs(tags)
+
+  archive = []
+  if page.config.get('archives', False):
+    archive = [(str(year), '{}/archive/{}'.format(base, year))
+               for year in sorted(years, reverse=True)]
+  _render_listing(context, page.config['url'], posts, per_page, page=page, archive=archive)
+
+  for post in posts:
+    post_tags = [(tag, '{}/tags/{}'.format(base, slugs[tag.lower()]))
+                 for tag in post.config.get('tags', [])]
+    context.render('{}/{}'.format(base, post.name), 'post.html', post=post, tags=post_tags)
+    context.copy_assets('{}/{}'.format(base, post.name), post)
+
+  if archive:
+    for year, year_posts in years.items():
+      # The listing of a year links to the listings of its months.
+      year_archive = [(datetime(year, month, 1).strftime('%B'),
+                       '{}/archive/{}/{:02d}'.format(base, year, month))
+                      for (y, month) in sorted(months, reverse=True) if y == year]
+      _render_listing(context, '{}/archive/{}'.format(base, year), year_posts,
+                      per_page, page=page, heading=str(year), archive=year_archive)
+    for (year, month), month_posts in months.items():
+      heading = datetime(year, month, 1).strftime('%B %Y')
+      _render_listing(context, '{}/archive/{}/{:02d}'.format(base, year, month),
+                      month_posts, per_page, page=page, heading=heading)
+
+  for key, (tag, tag_posts) in tags.items():
+    _render_listing(context, '{}/tags/{}'.format(base, slugs[key]), tag_posts,
+                    per_page, page=page, heading='#' + tag)
+
 def render(context):
   pages = context.load_content_from_directory('.')
   pages.sort(key=lambda p: (p.config.get('ordering', 9999), p.config.get('title', p.name)))
@@ -22,18 +123,16 @@ def render(context):
   for page in pages:
     page.config.setdefault('url', '/' + page.name)
 
+  # Every posts directory is loaded and sorted once, even if multiple pages
+  # display its posts.
+  post_index = {}
   for page in pages:
-    url = page.config['url']
     posts_dir = page.config.get('displayPostsFrom')
     if posts_dir:
-      posts = context.load_content_from_directory(posts_dir)
-      posts = [x for x in posts if not x.config.get('draft')]
-      posts.sort(key=lambda p: p.config.get('date', datetime.now()), reverse=True)
-      context.render(url, 'blog.html', page=page, posts=posts)
-      for post in posts:
-        context.render('{}/{}'.format(url, post.name), 'post.html', post=post)
-        context.copy_assets('{}/{}'.format(url, post.name), post)
+      if posts_dir not in post_index:
+        post_index[posts_dir] = _load_posts(context, posts_dir)
+      _render_blog(context, page, post_index[posts_dir])
     else:
-      context.render(url, 'page.html', page=page)
+      context.render(page.config['url'], 'page.html', page=page)
 
   context.copy('/static', 'static')
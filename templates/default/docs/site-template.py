@@ -1,12 +1,15 @@
 
+import itertools
+import re
+
 def _load_page_tree(context):
   root_pages = context.load_content_from_directory('.')
   sort_key = lambda p: (p.config.get('ordering', 9999), p.config['title'].lower())
   def recursion(parent, page):
     path = '{}/{}'.format(parent, page.name)
-    try:
+    if context.has_content_directory(path):
       page.children = context.load_content_from_directory(path)
-    except FileNotFoundError:
+    else:
       page.children = []
     for child in page.children:
       child.parent = page
@@ -25,15 +28,87 @@ def _traverse(pages):
   for page in pages:
     yield from _traverse(page.children)
 
+class _Navigation(object):
+  """
+  Renders the navigation of all *pages* for every page. The `toc()` macro of
+  `nav.html` is rendered once with placeholders. The relative URLs are
+  filled in once per directory that they are resolved from, and a page only
+  inserts its active marker and table of contents into the result of its
+  directory, instead of rendering the whole tree again.
+  """
+
+  # Only depends on the pages, which are fingerprinted on their own. Hashing
+  # its state would make every page depend on every other page.
+  __fingerprint__ = False
+
+  _placeholder = re.compile(r'\x00([aut])(\d+)\x00')
+
+  def __init__(self, context, pages):
+    self.context = context
+    self.roots = pages
+    self.pages = list(_traverse(pages))
+    self.index = {id(page): i for i, page in enumerate(self.pages)}
+    self.texts = None
+    self.directories = {}
+
+  def active(self, page):
+    return '\x00a{}\x00'.format(self.index[id(page)])
+
+  def url(self, page):
+    return '\x00u{}\x00'.format(self.index[id(page)])
+
+  def page_toc(self, page):
+    return '\x00t{}\x00'.format(self.index[id(page)])
+
+  def _prerender(self, templates):
+    # Splits the HTML into the texts between the URLs, and records the
+    # offset of the active marker and the table of contents of every page
+    # as the length of the texts and the number of URLs before them.
+    parts = self._placeholder.split(str(templates.toc(self.roots, self)))
+    texts, targets, offsets = [''], [], {}
+    length = 0
+    for i in range(0, len(parts), 3):
+      texts[-1] += parts[i]
+      length += len(parts[i])
+      if i + 1 < len(parts):
+        kind, page = parts[i + 1], self.pages[int(parts[i + 2])]
+        if kind == 'u':
+          targets.append(page.url)
+          texts.append('')
+        else:
+          offsets.setdefault(id(page), []).append((length, len(targets)))
+    self.texts, self.targets, self.offsets = texts, targets, offsets
+
+  def _fill(self, source):
+    urls = self.context.routes.urls_to(self.targets, source)
+    html = [None] * (len(self.texts) + len(urls))
+    html[::2] = self.texts
+    html[1::2] = urls
+    lengths = [0]
+    lengths.extend(itertools.accumulate(map(len, urls)))
+    return ''.join(html), lengths
+
+  def render(self, page, templates):
+    if self.texts is None:
+      self._prerender(templates)
+    key = self.context.routes.get_source_directory(page.url)
+    if key not in self.directories:
+      self.directories[key] = self._fill(page.url)
+    html, lengths = self.directories[key]
+    active, toc = (length + lengths[urls] for length, urls in self.offsets[id(page)])
+    return ''.join([html[:active], 'active', html[active:toc],
+                    str(templates.page_toc(page)), html[toc:]])
+
 def render(context):
   pages = _load_page_tree(context)
   index_page = next((p for p in pages if p.name == 'index'), None)
   if not index_page:
     raise Exception('no index page')
   index_page.url = '/'
+  nav = _Navigation(context, pages)
 
   for page in _traverse(pages):
-    context.render(page.url, 'page.html', page=page, pages=pages)
+    context.render(page.url, 'page.html', page=page, pages=pages, nav=nav)
   context.copy('/static', 'static')
 
 def content_loaded(context, page):
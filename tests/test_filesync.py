@@ -0,0 +1,30 @@
+import os
+import pytest
+import statigen
+
+
+@pytest.mark.parametrize('method', ['copy', 'reflink'])
+def test_switch_from_hardlink(tmpdir, method):
+  source = tmpdir.join('static', 'style.css')
+  source.write_binary(b'body { color: red }', ensure=True)
+  target = tmpdir.join('build', 'static', 'style.css')
+  files = [(str(source), str(target))]
+
+  sync = statigen.FileSync(str(tmpdir.join('copies.json')), 'hardlink')
+  sync.sync(files)
+  assert os.path.samefile(str(source), str(target))
+
+  sync = statigen.FileSync(str(tmpdir.join('copies.json')), method)
+  stats = sync.sync(files, force=True)
+  assert stats['copied'] == 1
+  assert source.read_binary() == b'body { color: red }'
+  assert target.read_binary() == b'body { color: red }'
+  assert not os.path.samefile(str(source), str(target))
+
+
+def test_copy_onto_itself(tmpdir):
+  source = tmpdir.join('style.css')
+  source.write_binary(b'body { color: red }')
+  sync = statigen.FileSync(str(tmpdir.join('copies.json')))
+  sync.sync([(str(source), str(source))], force=True)
+  assert source.read_binary() == b'body { color: red }'